@@ -6,76 +6,8 @@ from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout,
                              QLabel, QProgressBar, QCheckBox, QComboBox)
 from PyQt5.QtGui import QIcon
 import shutil
-import xml.etree.ElementTree as ET
-
-def get_nodata_from_vrt(vrt_path: str) -> float:
-    tree = ET.parse(vrt_path)
-    root = tree.getroot()
-    for band in root.findall("VRTRasterBand"):
-        nd = band.find("NoDataValue")
-        if nd is not None:
-            return nd.text
-    return None
-
-
-# Step 0: 定义插入 PixelFunction 的函数
-# Step 0: 定义插入 PixelFunction 的函数
-def add_pixel_fn(filename: str, function_name: str) -> None:
-    nodata = get_nodata_from_vrt(filename)
-    if nodata is None:
-        nodata = -9999
-
-    code = f"""
-    <PixelFunctionType>{function_name}</PixelFunctionType>
-    <PixelFunctionLanguage>Python</PixelFunctionLanguage>
-    <PixelFunctionCode><![CDATA[
-import numpy as np
-
-nodata = {nodata}
-
-def max(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
-    masked = np.ma.masked_equal(in_ar, nodata)
-    result = np.ma.max(masked, axis=0).filled(nodata)
-    np.copyto(out_ar, result)
-
-def min(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
-    masked = np.ma.masked_equal(in_ar, nodata)
-    result = np.ma.min(masked, axis=0).filled(nodata)
-    np.copyto(out_ar, result)
-
-def mean(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
-    masked = np.ma.masked_equal(in_ar, nodata)
-    result = np.ma.mean(masked, axis=0).filled(nodata)
-    np.copyto(out_ar, result)
-
-def sum(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
-    masked = np.ma.masked_equal(in_ar, nodata)
-    result = np.ma.sum(masked, axis=0).filled(nodata)
-    np.copyto(out_ar, result)
-
-def first(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
-    out_ar[:] = np.where(in_ar[0] == nodata, nodata, in_ar[0])
-
-def last(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
-    out_ar[:] = np.where(in_ar[-1] == nodata, nodata, in_ar[-1])
-]]>
-    </PixelFunctionCode>
-    """
-
-    lines = open(filename, 'r').readlines()
-    for i, line in enumerate(lines):
-        if '<VRTRasterBand' in line and 'subClass="VRTDerivedRasterBand"' not in line:
-            lines[i] = line.replace('<VRTRasterBand', '<VRTRasterBand subClass="VRTDerivedRasterBand"')
-        if '<PixelFunctionType>' in line:
-            # Already present, remove old function definition
-            while '</PixelFunctionCode>' not in lines[i]:
-                lines.pop(i)
-            lines.pop(i)  # remove </PixelFunctionCode>
-            break
-
-    insert_index = next(i for i, line in enumerate(lines) if '<VRTRasterBand' in line) + 1
-    lines.insert(insert_index, code + "\n")
-    open(filename, 'w').write("".join(lines))
+from vrt_merge import build_merge_vrt, warp_merged_vrt, PIXEL_FN_DESC
+from archive_inputs import find_inputs
 
 # ---------- 后台合并线程 ----------
 class MergeThread(QThread):
@@ -99,7 +31,8 @@ class MergeThread(QThread):
 
             def _progress(pct, msg, data):
                 self.progress.emit(int(pct * 100))
-                return 1
+                # 返回 0 让 gdal.Warp 停止处理
+                return 0 if self.isInterruptionRequested() else 1
 
             gdal.UseExceptions()
             self.log.emit("开始合并...")
@@ -113,25 +46,12 @@ class MergeThread(QThread):
             print(f"Found {len(self.asc_files)} input files.")
             
             vrt_path = f"{os.path.join(os.path.dirname(self.out_path), os.path.basename(self.out_path))}.vrt"
-            gdal.BuildVRT(vrt_path, self.asc_files)
-            self.opts['dstNodata'] = get_nodata_from_vrt(vrt_path)
-            # Step 2: 插入 PixelFunction（自动根据 VRT 读取 NoData）
-            add_pixel_fn(vrt_path, self.merge_method)
-
-            # Step 3: 应用 Python PixelFunction 并导出为 GeoTIFF
-            gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', 'YES')
-            ds = gdal.Open(vrt_path)
-
-            if ds is None:
-                raise RuntimeError("Failed to open the VRT dataset. Check if PixelFunction is valid.")
-
-            gdal.Warp(self.out_path, ds, **self.opts,
-                    callback=_progress)
-            # ✅ 关键：刷新缓存并关闭
-            out_ds = gdal.Open(self.out_path, gdal.GA_Update)
-            if out_ds:
-                out_ds.FlushCache()  # 强制写盘
-                out_ds = None 
+            # Step 2: 设置融合规则（自动根据 VRT 读取 NoData）
+            used, self.opts['dstNodata'] = build_merge_vrt(vrt_path, self.asc_files, self.merge_method)
+            self.log.emit(f"融合方式: {PIXEL_FN_DESC[used]}")
+
+            # Step 3: 导出为 GeoTIFF
+            warp_merged_vrt(vrt_path, self.out_path, self.opts, used, callback=_progress)
             self.progress.emit(100)       # 关闭数据集 
             self.log.emit(f"✅ 合并完成：{self.out_path}")
         except Exception as e:
@@ -184,29 +104,17 @@ class HDFMergeThread(QThread):
                 print("No input .asc files found.")
                 return
             vrt_path = f"{os.path.join(self.temp_dir, os.path.basename(self.out_path))}.vrt"
-            gdal.BuildVRT(vrt_path, asc_files)
-            self.opts['dstNodata'] = get_nodata_from_vrt(vrt_path)
-            # Step 2: 插入 PixelFunction（自动根据 VRT 读取 NoData）
-            add_pixel_fn(vrt_path, self.merge_method)
-
-            # Step 3: 应用 Python PixelFunction 并导出为 GeoTIFF
-            gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', 'YES')
-            ds = gdal.Open(vrt_path)
-
-            if ds is None:
-                raise RuntimeError("Failed to open the VRT dataset. Check if PixelFunction is valid.")
+            # Step 2: 设置融合规则（自动根据 VRT 读取 NoData）
+            used, self.opts['dstNodata'] = build_merge_vrt(vrt_path, asc_files, self.merge_method)
+            self.log.emit(f"融合方式: {PIXEL_FN_DESC[used]}")
 
+            # Step 3: 导出为 GeoTIFF
             def _progress(pct, msg, data):
                 self.progress.emit(int(pct * 100))
-                return 1
+                # 返回 0 让 gdal.Warp 停止处理
+                return 0 if self.isInterruptionRequested() else 1
             
-            gdal.Warp(self.out_path, ds, **self.opts,
-                    callback=_progress)
-            # ✅ 关键：刷新缓存并关闭
-            out_ds = gdal.Open(self.out_path, gdal.GA_Update)
-            if out_ds:
-                out_ds.FlushCache()  # 强制写盘
-                out_ds = None 
+            warp_merged_vrt(vrt_path, self.out_path, self.opts, used, callback=_progress)
             self.progress.emit(100)       # 关闭数据集 
             self.log.emit(f"✅ 合并完成：{self.out_path}")
           
@@ -449,10 +357,8 @@ class MergerUI(QWidget):
                 return []
             exts = [f"*.{e.strip()}" for e in raw.split(',')]
 
-        files = []
-        for e in exts:
-            files.extend(glob.glob(os.path.join(folder, e)))
-        return sorted(files)
+        # 目录中的 zip / tar / gz 压缩包也一并查找，无需先解压
+        return find_inputs(folder, exts)
 
     def start_merge(self):
         in_dir = self.le_in_dir.text()
@@ -532,7 +438,7 @@ class MergerUI(QWidget):
 
     def closeEvent(self, event):
         if hasattr(self, 'worker') and self.worker.isRunning():
-            self.worker.terminate()  # 请求线程终止
+            self.worker.requestInterruption()  # 请求线程中断，gdal.Warp 在下次进度回调时停止
             self.worker.wait()  # 等待线程实际结束
         event.accept()
 
@@ -2,7 +2,7 @@
 
 
 a = Analysis(
-    ['RSData_Merger_Tool.py'],
+    ['RSData_Merger_Tool.py','vrt_merge.py','archive_inputs.py'],
     pathex=[],
     binaries=[],
     datas=[('app_icon.ico', '.')],
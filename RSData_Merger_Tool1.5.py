@@ -1,22 +1,17 @@
 # MergerUI.py
 import os, sys, traceback, glob, shutil
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout,
                              QPushButton, QLineEdit, QTextEdit, QFileDialog,
                              QLabel, QProgressBar, QCheckBox, QComboBox)
 from PyQt5.QtGui import QIcon
 from osgeo import gdal
-from mosaic_overlap import mosaic_overlap
-import os
+from mosaic_overlap import mosaic_overlap, mosaic_groups, parse_aoi
+from temporal_groups import group_files
+from archive_inputs import find_inputs
+from input_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_BYTES
 import signal
 
-def signal_handler(signum, frame):
-    print(f"收到信号 {signum}，强制退出进程")
-    os._exit(1)
-
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
 # ---------- MergeThread ----------
 class MergeThread(QThread):
     log = pyqtSignal(str)
@@ -33,6 +28,9 @@ class MergeThread(QThread):
     def run(self):
         try:
             self.log.emit(f"找到 {len(self.files)} 个文件")
+            if self.opts.get('group_period'):
+                self.run_groups()
+                return
             mosaic_overlap(
                 files=self.files,
                 out_path=self.out_path,
@@ -43,20 +41,62 @@ class MergeThread(QThread):
                 dst_nodata=self.opts.get('dstNodata'),
                 dst_crs=self.opts.get('dstSRS'),
                 creation_options=self.opts.get('creationOptions', ['COMPRESS=LZW', 'TILED=YES']),
-                # resample=self.opts.get('resample', 'nearest'),
+                resample=self.opts.get('resample', 'nearest'),
+                target_res=self.opts.get('target_res'), # 输出分辨率
+                aoi=self.opts.get('aoi'), # 感兴趣区
                 flush_interval = self.opts.get('flush_interval', 100),
+                bands=self.opts.get('bands'), # 波段选择
+                dry_run=self.opts.get('dry_run', False), # 只规划不处理
+                stats=self.opts.get('stats', False), # 同步写入统计信息
+                input_cache_dir=self.opts.get('input_cache_dir'), # ASC / PNG 输入先转成分块 GeoTIFF 缓存
+                input_cache_bytes=self.opts.get('input_cache_bytes', DEFAULT_CACHE_BYTES), # 缓存容量上限
                 log = self.log.emit,  # 日志回调
                 error = self.error.emit,  # 错误回调
                 thread_obj=self,  # 把线程自身传进去
                 progress_cb=lambda pct: self.progress.emit(pct)
             )
-            self.log.emit(f"✅ 合并完成：{self.out_path}")
+            if self.opts.get('dry_run'):
+                self.log.emit("✅ 预估完成，未写出文件")
+            else:
+                self.log.emit(f"✅ 合并完成：{self.out_path}")
         except InterruptedError as e:
             self.log.emit(str(e))
         except Exception as e:
             self.error.emit(f"合并失败: {str(e)}")
             self.error.emit(traceback.format_exc())
 
+    def run_groups(self):
+        """按文件名日期分组，一次输出多幅合成"""
+        groups = group_files(self.files, 'date', self.opts['group_period'])
+        if not groups:
+            raise RuntimeError("未能从文件名中解析出日期")
+        self.log.emit(f"按日期分为 {len(groups)} 组：{', '.join(groups)}")
+        mosaic_groups(
+            groups,
+            self.out_path,
+            method=self.method,
+            block_size=self.opts.get('block_size'),
+            n_workers=self.opts.get('n_workers', 2),
+            dst_dtype=self.opts.get('dst_dtype'),
+            dst_nodata=self.opts.get('dstNodata'),
+            dst_crs=self.opts.get('dstSRS'),
+            creation_options=self.opts.get('creationOptions', ['COMPRESS=LZW', 'TILED=YES']),
+            resample=self.opts.get('resample', 'nearest'),
+            target_res=self.opts.get('target_res'),
+            bands=self.opts.get('bands'),
+            aoi=self.opts.get('aoi'), # 感兴趣区
+            stats=self.opts.get('stats', False), # 同步写入统计信息
+            dry_run=self.opts.get('dry_run', False), # 只规划不处理
+            input_cache_dir=self.opts.get('input_cache_dir'),
+            input_cache_bytes=self.opts.get('input_cache_bytes', DEFAULT_CACHE_BYTES),
+            log=self.log.emit,
+            error=self.error.emit,
+            thread_obj=self,
+            progress_cb=lambda pct: self.progress.emit(pct)
+        )
+        if self.opts.get('dry_run'):
+            self.log.emit("✅ 预估完成，未写出文件")
+
 # ---------- HDFMergeThread ----------
 class HDFMergeThread(QThread):
     log = pyqtSignal(str)
@@ -98,14 +138,24 @@ class HDFMergeThread(QThread):
                 dst_nodata=self.opts.get('dstNodata'),
                 dst_crs=self.opts.get('dstSRS'),
                 creation_options=self.opts.get('creationOptions', ['COMPRESS=LZW', 'TILED=YES']),
-                # resample=self.opts.get('resample', 'nearest'),
+                resample=self.opts.get('resample', 'nearest'),
+                target_res=self.opts.get('target_res'), # 输出分辨率
+                aoi=self.opts.get('aoi'), # 感兴趣区
                 flush_interval = self.opts.get('flush_interval', 100),
+                bands=self.opts.get('bands'), # 波段选择
+                dry_run=self.opts.get('dry_run', False), # 只规划不处理
+                stats=self.opts.get('stats', False), # 同步写入统计信息
                 log = self.log.emit,  # 日志回调
                 error = self.error.emit,  # 错误回调
                 thread_obj=self,  # 把线程自身传进去
                 progress_cb=lambda pct: self.progress.emit(pct)
             )
-            self.log.emit("✅ HDF 子数据集合并完成")
+            if self.opts.get('dry_run'):
+                self.log.emit("✅ 预估完成，未写出文件")
+            else:
+                self.log.emit("✅ HDF 子数据集合并完成")
+        except InterruptedError as e:
+            self.log.emit(str(e))
         except Exception as e:
             self.error.emit(f"HDF 合并失败: {str(e)}")
             self.error.emit(traceback.format_exc())
@@ -180,10 +230,20 @@ class MergerUI(QWidget):
         h_method = QHBoxLayout()
         h_method.addWidget(QLabel('<font color="red">*</font>融合方法:'))
         self.cb_method = QComboBox()
-        self.cb_method.addItems(["mean", "max", "min",  "sum", "first", "last"])  
+        self.cb_method.addItems(["mean", "max", "min",  "sum", "first", "last", "feather"])  
         h_method.addWidget(self.cb_method)  
         v.addLayout(h_method)
 
+        # 按日期分组输出
+        h_group = QHBoxLayout()
+        h_group.addWidget(QLabel("按日期分组:"))
+        self.cb_group = QComboBox()
+        self.cb_group.addItems(["不分组", "按日", "按月", "按年"])
+        self.cb_group.setToolTip("从文件名解析日期（如 20240101、2024-01-01、A2024001），"
+                                 "每组输出一幅，文件名后加 _日期")
+        h_group.addWidget(self.cb_group)
+        v.addLayout(h_group)
+
         # warp 选项
         # h_warp = QHBoxLayout()
         # h_warp.addWidget(QLabel('重采样算法:'))
@@ -239,6 +299,48 @@ class MergerUI(QWidget):
         h_nodata.addWidget(self.le_nodata)
         v.addLayout(h_nodata)
 
+        # 波段选择
+        h_bands = QHBoxLayout()
+        h_bands.addWidget(QLabel("输出波段(逗号分隔):"))
+        self.le_bands = QLineEdit()
+        self.le_bands.setText("")   # 默认为空
+        self.le_bands.setToolTip(
+            "留空：输出全部波段\n"
+            "示例：4,3,2 → 只读取并输出第 4、3、2 波段\n"
+            "波段序号从 1 开始"
+        )
+        self.le_bands.setMouseTracking(True)   # 关键
+        h_bands.addWidget(self.le_bands)
+        v.addLayout(h_bands)
+
+        # 输出分辨率
+        h_res = QHBoxLayout()
+        h_res.addWidget(QLabel("输出分辨率:"))
+        self.le_res = QLineEdit()
+        self.le_res.setText("")   # 默认为空
+        self.le_res.setToolTip(
+            "留空：使用输入中最细的分辨率\n"
+            "示例：100 或 100,100 → 输出 100 米（坐标系单位）分辨率，\n"
+            "较粗时直接读取源影像的概视图，读取量大幅减少"
+        )
+        self.le_res.setMouseTracking(True)   # 关键
+        h_res.addWidget(self.le_res)
+        v.addLayout(h_res)
+
+        # 感兴趣区
+        h_aoi = QHBoxLayout()
+        h_aoi.addWidget(QLabel("感兴趣区(AOI):"))
+        self.le_aoi = QLineEdit()
+        self.le_aoi.setText("")   # 默认为空
+        self.le_aoi.setToolTip(
+            "留空：输出全部输入范围\n"
+            "示例：minx,miny,maxx,maxy（输入影像坐标系）\n"
+            "或矢量文件路径（如 .shp/.geojson），面外像素置为 nodata"
+        )
+        self.le_aoi.setMouseTracking(True)   # 关键
+        h_aoi.addWidget(self.le_aoi)
+        v.addLayout(h_aoi)
+
         # warpMemoryLimit
         # 内存限制自定义
         h_mem = QHBoxLayout()
@@ -284,8 +386,35 @@ class MergerUI(QWidget):
         self.chk_big = QCheckBox("启用 BIGTIFF")
         self.chk_big.setChecked(True)          # 默认打开
 
+        # 只做规划和资源预估
+        self.chk_dry = QCheckBox("仅预估 (dry run)")
+        self.chk_dry.setChecked(False)
+        self.chk_dry.setToolTip("只统计窗口数、重叠深度、读写量和峰值内存，不处理像素")
+
+        # 写出时同步统计，省去 gdalinfo -stats -hist
+        self.chk_stats = QCheckBox("写入统计信息")
+        self.chk_stats.setChecked(False)
+        self.chk_stats.setToolTip("拼接时同步计算各波段最小/最大/均值/标准差和直方图，写入 .aux.xml")
+
+        # ASC / PNG 等慢速格式先转成分块 GeoTIFF 缓存，默认关闭
+        self.chk_cache = QCheckBox("输入转换缓存")
+        self.chk_cache.setChecked(False)
+        self.chk_cache.setToolTip(
+            "ASC / PNG 等需要整体解析的输入先转成分块压缩 GeoTIFF，缓存在\n"
+            f"{DEFAULT_CACHE_DIR}\n"
+            "源文件未改动时下次直接复用，超出容量上限按最近使用淘汰"
+        )
+        self.le_cache_gb = QLineEdit(str(DEFAULT_CACHE_BYTES // 1024 ** 3))
+        self.le_cache_gb.setFixedWidth(50)
+        self.le_cache_gb.setToolTip("转换缓存目录容量上限（GB）")
+
         h_check = QHBoxLayout()
         h_check.addWidget(self.chk_big)
+        h_check.addWidget(self.chk_dry)
+        h_check.addWidget(self.chk_stats)
+        h_check.addWidget(self.chk_cache)
+        h_check.addWidget(QLabel("缓存上限(GB):"))
+        h_check.addWidget(self.le_cache_gb)
         h_check.addStretch()  # 让两个复选框靠左
         v.addLayout(h_check)
 
@@ -298,10 +427,16 @@ class MergerUI(QWidget):
         self.progress_bar = QProgressBar()  
         v.addWidget(self.progress_bar)
 
-        # 合并按钮
+        # 合并 / 取消按钮
+        h_btn = QHBoxLayout()
         self.btn_merge = QPushButton("开始合并")
         self.btn_merge.clicked.connect(self.start_merge)
-        v.addWidget(self.btn_merge)
+        h_btn.addWidget(self.btn_merge)
+        self.btn_cancel = QPushButton("取消")
+        self.btn_cancel.setEnabled(False)
+        self.btn_cancel.clicked.connect(self.cancel_merge)
+        h_btn.addWidget(self.btn_cancel)
+        v.addLayout(h_btn)
 
     def update_subdataset_list(self, directory):
         self.cb_subdataset.clear()
@@ -368,10 +503,8 @@ class MergerUI(QWidget):
         else:
             exts = [f"*.{selected}"]
 
-        files = []
-        for pattern in exts:
-            files.extend(glob.glob(os.path.join(folder, pattern)))
-        return sorted(files)
+        # 目录中的 zip / tar / gz 压缩包也一并查找，无需先解压
+        return find_inputs(folder, exts)
 
     def start_merge(self):
         in_dir = self.le_in_dir.text()
@@ -400,6 +533,8 @@ class MergerUI(QWidget):
             'creationOptions': creation_opts, # GDAL 写入选项
             'dst_dtype': self.cb_type.currentText(),  # 输出像素类型
             'flush_interval': int(self.le_flush.text()),  # 输出像素类型
+            'dry_run': self.chk_dry.isChecked(),  # 只规划不处理
+            'stats': self.chk_stats.isChecked(),  # 同步写入统计信息
         }
         # 输出坐标系设置
         srs_text = self.le_srs.text().strip()
@@ -409,6 +544,28 @@ class MergerUI(QWidget):
         nodata_text = self.le_nodata.text().strip()
         if nodata_text:                      # 非空才设置
             opts['dstNodata'] = int(nodata_text)
+        # 波段选择
+        bands_text = self.le_bands.text().strip()
+        if bands_text:
+            opts['bands'] = [int(b) for b in bands_text.split(',') if b.strip()]
+        # 输出分辨率，降采样时使用均值重采样
+        res_text = self.le_res.text().strip()
+        if res_text:
+            res = [float(r) for r in res_text.split(',') if r.strip()]
+            opts['target_res'] = res[0] if len(res) == 1 else tuple(res[:2])
+            opts['resample'] = 'average'
+        # 分组周期
+        period = {"按日": 'day', "按月": 'month', "按年": 'year'}.get(self.cb_group.currentText())
+        if period:
+            opts['group_period'] = period
+        # 感兴趣区
+        aoi_text = self.le_aoi.text().strip()
+        if aoi_text:
+            opts['aoi'] = parse_aoi(aoi_text)
+        # 输入转换缓存
+        if self.chk_cache.isChecked():
+            opts['input_cache_dir'] = DEFAULT_CACHE_DIR
+            opts['input_cache_bytes'] = int(float(self.le_cache_gb.text()) * 1024 ** 3)
         self.log(f"选项：{opts}")
         # print(opts)
         self.progress_bar.setValue(0)
@@ -426,25 +583,46 @@ class MergerUI(QWidget):
             self.worker.log.connect(self.log)
             self.worker.error.connect(self.error)
             self.worker.progress.connect(self.progress_bar.setValue)
-            self.worker.finished.connect(lambda: self.btn_merge.setEnabled(True))
+            self.worker.finished.connect(self.on_finished)
             self.worker.start()
+            self.btn_cancel.setEnabled(True)
             return
         
         self.worker = MergeThread(files, out_file, opts, self.cb_method.currentText())
         self.worker.log.connect(self.log)
         self.worker.error.connect(self.error)
         self.worker.progress.connect(self.progress_bar.setValue)
-        self.worker.finished.connect(lambda: self.btn_merge.setEnabled(True))
+        self.worker.finished.connect(self.on_finished)
         self.worker.start()
+        self.btn_cancel.setEnabled(True)
+
+    def on_finished(self):
+        self.btn_merge.setEnabled(True)
+        self.btn_cancel.setEnabled(False)
+
+    def cancel_merge(self):
+        # 协作式取消：不再派发新窗口，正在处理的窗口完成后线程自行退出
+        if hasattr(self, 'worker') and self.worker.isRunning():
+            self.worker.requestInterruption()
+            self.btn_cancel.setEnabled(False)
+            self.log("正在取消，等待当前窗口完成……")
 
     def closeEvent(self, event):
         if hasattr(self, 'worker') and self.worker.isRunning():
             self.worker.requestInterruption()  # 请求线程中断
-            self.worker.quit()  # 退出事件
+            self.worker.wait()  # 等待正在处理的窗口完成，输出文件正常关闭
+        event.accept()
 
 # ---------- 入口 ----------
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     win = MergerUI()
     win.show()
+    # Ctrl+C / SIGTERM 走正常关闭流程，协作式取消后台任务
+    signal.signal(signal.SIGINT, lambda signum, frame: win.close())
+    signal.signal(signal.SIGTERM, lambda signum, frame: win.close())
+    # 定时回到 Python 解释器，让信号处理函数有机会执行
+    timer = QTimer()
+    timer.start(200)
+    timer.timeout.connect(lambda: None)
     sys.exit(app.exec_())
\ No newline at end of file
@@ -2,7 +2,7 @@
 
 
 a = Analysis(
-    ['RSData_Merger_Tool1.5.py','mosaic_overlap.py'],
+    ['RSData_Merger_Tool1.5.py','mosaic_overlap.py','archive_inputs.py','temporal_groups.py','input_cache.py'],
     pathex=[],
     binaries=[],
     datas=[('app_icon.ico', '.')],
@@ -0,0 +1,109 @@
+# archive_inputs.py
+import fnmatch
+import glob
+import os
+import tarfile
+import threading
+import zipfile
+from typing import Dict, List, Tuple
+
+# 压缩包后缀 -> GDAL 虚拟文件系统前缀（长后缀在前，保证 .tar.gz 优先于 .gz）
+ARCHIVE_VSI = (
+    ('.tar.gz', '/vsitar/'),
+    ('.tgz', '/vsitar/'),
+    ('.tar', '/vsitar/'),
+    ('.zip', '/vsizip/'),
+    ('.gz', '/vsigzip/'),
+)
+
+# 命令行直接给出压缩包时默认匹配的栅格后缀
+RASTER_PATTERNS = ['*.tif', '*.tiff', '*.asc', '*.img', '*.jp2', '*.png', '*.nc', '*.hdf']
+
+# 压缩包路径 -> (mtime, size, 成员列表)，文件未变化时不再解析目录
+_listing_cache: Dict[str, Tuple[float, int, List[str]]] = {}
+_listing_lock = threading.Lock()
+
+
+def archive_prefix(path: str):
+    """返回压缩包对应的 VSI 前缀，不是压缩包时返回 None"""
+    lower = path.lower()
+    for ext, prefix in ARCHIVE_VSI:
+        if lower.endswith(ext):
+            return prefix
+    return None
+
+
+def is_vsi_path(path: str) -> bool:
+    return path.replace('\\', '/').startswith('/vsi')
+
+
+def list_archive(path: str) -> List[str]:
+    """列出压缩包内的文件成员（带缓存）"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    with _listing_lock:
+        cached = _listing_cache.get(path)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+
+    prefix = archive_prefix(path)
+    if prefix == '/vsizip/':
+        with zipfile.ZipFile(path) as zf:
+            members = [i.filename for i in zf.infolist() if not i.is_dir()]
+    elif prefix == '/vsitar/':
+        with tarfile.open(path) as tf:
+            members = [m.name for m in tf.getmembers() if m.isfile()]
+    elif prefix == '/vsigzip/':
+        # 单文件 gzip，成员名即去掉 .gz 的文件名
+        members = [os.path.basename(path)[:-3]]
+    else:
+        raise ValueError(f"Unsupported archive: {path}")
+
+    with _listing_lock:
+        _listing_cache[path] = (st.st_mtime, st.st_size, members)
+    return members
+
+
+def vsi_path(archive: str, member: str = None) -> str:
+    """拼出 GDAL 可直接打开的虚拟路径，如 /vsizip/D:/data/a.zip/b.tif"""
+    prefix = archive_prefix(archive)
+    if prefix is None:
+        raise ValueError(f"Unsupported archive: {archive}")
+    archive = os.path.abspath(archive).replace('\\', '/')
+    if prefix == '/vsigzip/':
+        return prefix + archive
+    return f"{prefix}{archive}/{member}"
+
+
+def archive_members(archive: str, patterns: List[str]) -> List[str]:
+    """返回压缩包内文件名匹配 patterns 的成员的 VSI 路径"""
+    out = []
+    for member in list_archive(archive):
+        name = os.path.basename(member).lower()
+        if any(fnmatch.fnmatch(name, p.lower()) for p in patterns):
+            out.append(vsi_path(archive, member))
+    return out
+
+
+def find_inputs(folder: str, patterns: List[str]) -> List[str]:
+    """查找目录下匹配 patterns 的栅格，连同目录中各压缩包内的匹配成员"""
+    files = []
+    for pattern in patterns:
+        files.extend(glob.glob(os.path.join(folder, pattern)))
+    for entry in sorted(os.listdir(folder)):
+        path = os.path.join(folder, entry)
+        if os.path.isfile(path) and archive_prefix(entry) and path not in files:
+            files.extend(archive_members(path, patterns))
+    return sorted(set(files))
+
+
+def expand_inputs(paths: List[str], patterns: List[str] = None) -> List[str]:
+    """把输入列表中的压缩包展开为其中的栅格成员，其他路径（含 VSI 路径）原样保留"""
+    patterns = patterns or RASTER_PATTERNS
+    out = []
+    for p in paths:
+        if not is_vsi_path(p) and archive_prefix(p) and os.path.isfile(p):
+            out.extend(archive_members(p, patterns))
+        else:
+            out.append(p)
+    return out
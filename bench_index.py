@@ -0,0 +1,87 @@
+# bench_index.py
+# 对比逐条插入 + 逐窗口查询与批量构建 + 按行复用查询的索引与规划耗时（只用合成外包框，不读写影像）
+# 用法: python bench_index.py [--scenes 1000,10000,100000] [--depth 4] [--rows 8]
+import time
+import argparse
+import numpy as np
+from rtree import index
+from mosaic_overlap import FootprintIndex
+
+TILE = 109800.0  # Sentinel-2 图幅边长（米）
+STEP = 99960.0   # 相邻图幅间距，约 10% 重叠
+
+
+def make_footprints(n_scenes, depth, seed=0):
+    """按网格排布图幅，每个位置叠 depth 景（模拟重访），位置略加抖动"""
+    rng = np.random.default_rng(seed)
+    n_cells = max(1, n_scenes // depth)
+    cols = int(np.ceil(np.sqrt(n_cells)))
+    cell = np.arange(n_scenes) % n_cells
+    r, c = np.divmod(cell, cols)
+    jitter = rng.uniform(-50, 50, size=(n_scenes, 2))
+    left = c * STEP + jitter[:, 0]
+    top = -r * STEP + jitter[:, 1]
+    return np.column_stack([left, top - TILE, left + TILE, top])
+
+
+def sample_windows(boxes, n_rows, block_size, res):
+    """在整体范围内均匀抽取 n_rows 行窗口，返回各窗口的范围"""
+    left, bottom = boxes[:, 0].min(), boxes[:, 1].min()
+    right, top = boxes[:, 2].max(), boxes[:, 3].max()
+    size = block_size * res
+    n_cols = int(np.ceil((right - left) / size))
+    total_rows = int(np.ceil((top - bottom) / size))
+    rows = np.linspace(0, total_rows - 1, min(n_rows, total_rows)).astype(int)
+    windows = [(left + c * size, top - (r + 1) * size, left + (c + 1) * size, top - r * size)
+               for r in rows for c in range(n_cols)]
+    return windows, n_cols * total_rows
+
+
+def bench_legacy(boxes, windows):
+    t0 = time.perf_counter()
+    idx = index.Index()
+    for i, b in enumerate(boxes.tolist()):
+        idx.insert(i, tuple(b))
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    n = 0
+    for w in windows:
+        n += len(sorted(idx.intersection(w)))
+    return t_build, time.perf_counter() - t0, n
+
+
+def bench_footprint(boxes, windows):
+    t0 = time.perf_counter()
+    idx = FootprintIndex(boxes)
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    n = 0
+    for w in windows:
+        n += len(idx.candidates(w))
+    return t_build, time.perf_counter() - t0, n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="源外包框索引与窗口规划性能对比")
+    parser.add_argument('--scenes', default='1000,10000,100000')
+    parser.add_argument('--depth', type=int, default=4, help="每个图幅位置叠加的景数")
+    parser.add_argument('--rows', type=int, default=8, help="每个规模抽样的窗口行数")
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--res', type=float, default=10.0)
+    args = parser.parse_args()
+
+    print(f"{'景数':>8} {'窗口总数':>12} {'抽样':>8} | {'逐条建树':>9} {'逐窗口查询':>11} | "
+          f"{'批量建树':>9} {'按行查询':>9} | {'µs/窗口(旧)':>11} {'µs/窗口(新)':>11}")
+    for n_scenes in (int(s) for s in args.scenes.split(',')):
+        boxes = make_footprints(n_scenes, args.depth)
+        windows, n_total = sample_windows(boxes, args.rows, args.block_size, args.res)
+        lb, lq, ln = bench_legacy(boxes, windows)
+        fb, fq, fn = bench_footprint(boxes, windows)
+        # 旧方式包含只接触边界的源，新方式只保留有正面积重叠的源
+        assert fn <= ln
+        print(f"{n_scenes:>8} {n_total:>12} {len(windows):>8} | {lb:>8.2f}s {lq:>10.2f}s | "
+              f"{fb:>8.2f}s {fq:>8.2f}s | {lq / len(windows) * 1e6:>11.1f} {fq / len(windows) * 1e6:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
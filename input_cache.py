@@ -0,0 +1,141 @@
+# input_cache.py
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from osgeo import gdal
+from archive_inputs import is_vsi_path
+
+# 需要整体解析或不支持按块随机读取的格式：每次窗口读取都要从头解码，转成分块 GeoTIFF 后再读
+SLOW_DRIVERS = {'AAIGrid', 'XYZ', 'PNG', 'JPEG', 'GIF', 'BMP'}
+# 上述格式的常见扩展名，只有扩展名匹配的输入才打开确认驱动
+SLOW_EXTENSIONS = {'.asc', '.xyz', '.png', '.jpg', '.jpeg', '.gif', '.bmp'}
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'rsdata_merge_cache')
+DEFAULT_CACHE_BYTES = 10 * 1024 ** 3  # 10GB
+
+CACHE_OPTIONS = ['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+
+# 缓存键 -> 锁，同一源只转换一次，其他线程等待其完成
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+
+
+def _source_stat(path: str):
+    """返回 (size, mtime)，本地路径和 VSI 路径都可用；取不到时返回 None"""
+    if is_vsi_path(path):
+        st = gdal.VSIStatL(path)
+        return (st.size, st.mtime) if st is not None else None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def needs_cache(path: str) -> bool:
+    """源格式是否属于需要转换的慢速格式"""
+    if os.path.splitext(path)[1].lower() not in SLOW_EXTENSIONS:
+        return False
+    ds = gdal.Open(path)
+    if ds is None:
+        return False
+    driver = ds.GetDriver().ShortName
+    ds = None
+    return driver in SLOW_DRIVERS
+
+
+def cache_key(path: str, stat) -> str:
+    """由路径、大小和修改时间得到缓存文件名，源文件变化后自动失效"""
+    raw = f"{os.path.abspath(path) if not is_vsi_path(path) else path}|{stat[0]}|{stat[1]}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _key_lock(key: str) -> threading.Lock:
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def cached_path(path: str, cache_dir: str = DEFAULT_CACHE_DIR, log=None) -> str:
+    """返回源对应的缓存 GeoTIFF 路径（必要时先转换）；不需要缓存的源原样返回"""
+    if not needs_cache(path):
+        return path
+    stat = _source_stat(path)
+    if stat is None:
+        return path
+    key = cache_key(path, stat)
+    out = os.path.join(cache_dir, f"{key}.tif")
+    with _key_lock(key):
+        if os.path.exists(out):
+            # 刷新修改时间，淘汰时按最近使用排序
+            os.utime(out)
+            return out
+        os.makedirs(cache_dir, exist_ok=True)
+        # 先写临时文件再改名，中断或多进程并发时不会留下不完整的缓存
+        tmp = os.path.join(cache_dir, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp.tif")
+        ds = gdal.Translate(tmp, path, format='GTiff', creationOptions=CACHE_OPTIONS)
+        if ds is None:
+            raise RuntimeError(f"无法转换输入文件: {path}")
+        ds = None
+        os.replace(tmp, out)
+        if log:
+            log(f"[cache] 已转换 {os.path.basename(path)} -> {out}")
+    return out
+
+
+def evict(cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_BYTES, keep=()) -> int:
+    """缓存目录超过 max_bytes 时按最近使用时间从旧到新删除，keep 中的文件不删；返回删除的文件数"""
+    if not os.path.isdir(cache_dir):
+        return 0
+    keep = {os.path.abspath(p) for p in keep}
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.tif') or name.endswith('.tmp.tif'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def cached_inputs(files: List[str], cache_dir: str = DEFAULT_CACHE_DIR,
+                  max_bytes: int = DEFAULT_CACHE_BYTES, log=None, n_workers: int = 4) -> List[str]:
+    """把输入中的慢速格式替换为缓存的分块 GeoTIFF，顺序不变，随后按容量淘汰旧缓存
+
+    先按扩展名筛出候选，只有候选才打开确认格式；多个候选用 n_workers 个线程并行转换。
+    """
+    out = list(files)
+    todo = [i for i, f in enumerate(files) if os.path.splitext(f)[1].lower() in SLOW_EXTENSIONS]
+    if len(todo) > 1 and n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            converted = list(pool.map(lambda f: cached_path(f, cache_dir, log), [files[i] for i in todo]))
+    else:
+        converted = [cached_path(files[i], cache_dir, log) for i in todo]
+    for i, p in zip(todo, converted):
+        out[i] = p
+    used = [p for p, f in zip(out, files) if p != f]
+    if used:
+        removed = evict(cache_dir, max_bytes, keep=used)
+        if log:
+            log(f"[cache] {len(used)} 个输入使用转换缓存"
+                + (f"，淘汰 {removed} 个旧缓存" if removed else ""))
+    return out
@@ -0,0 +1,165 @@
+# merge_engine.py
+import os
+from typing import List, Tuple
+import rasterio
+from osgeo import gdal
+from mosaic_overlap import build_rtree_index, mosaic_overlap
+from vrt_merge import build_merge_vrt, warp_merged_vrt, native_pixel_fn_available, PIXEL_FN_DESC
+from archive_inputs import expand_inputs
+
+ENGINES = ('auto', 'windowed', 'vrt')
+
+# 经验阈值：文件数不多且重叠面积占比低时，VRT + gdal.Warp 更快
+VRT_MAX_FILES = 16
+VRT_MAX_OVERLAP = 0.25
+
+# 只有分块引擎支持的参数：设置了这些参数时 auto 选择分块引擎，强制 vrt 时报错
+WINDOWED_ONLY = ('dry_run', 'memory_limit', 'aoi', 'stats', 'tile_format', 'zoom_levels',
+                 'shard_index', 'shard_count')
+
+
+def windowed_only_options(kwargs: dict) -> List[str]:
+    """kwargs 中设置了非默认值、VRT 引擎无法处理的参数名"""
+    defaults = {'shard_count': 1, 'shard_index': 0}
+    return [k for k in WINDOWED_ONLY
+            if kwargs.get(k) not in (None, False, defaults.get(k))]
+
+
+def footprint_stats(files: List[str]) -> dict:
+    """基于头信息和 R-tree 统计文件数、重叠深度以及 CRS / 分辨率是否一致"""
+    crs_set = set()
+    res_set = set()
+    bounds_list = []
+    for f in files:
+        with rasterio.open(f) as src:
+            crs_set.add(src.crs.to_string() if src.crs else None)
+            res_set.add((round(src.res[0], 9), round(src.res[1], 9)))
+            bounds_list.append(src.bounds)
+
+    rtree_idx, _ = build_rtree_index(files, bounds_list)
+    depths = []
+    total_area = 0.0
+    overlap_area = 0.0
+    for i, b in enumerate(bounds_list):
+        total_area += (b.right - b.left) * (b.top - b.bottom)
+        # 与该文件真正重叠（面积大于 0）的文件数，含自身
+        depth = 0
+        for fid in rtree_idx.intersection((b.left, b.bottom, b.right, b.top)):
+            o = bounds_list[fid]
+            dx = min(b.right, o.right) - max(b.left, o.left)
+            dy = min(b.top, o.top) - max(b.bottom, o.bottom)
+            if dx > 0 and dy > 0:
+                depth += 1
+                if fid > i:
+                    overlap_area += dx * dy
+        depths.append(depth)
+
+    return {
+        'files': len(files),
+        'mean_depth': sum(depths) / len(depths) if depths else 0,
+        'max_depth': max(depths) if depths else 0,
+        # 两两相交面积之和占全部面积之比
+        'overlap_ratio': overlap_area / total_area if total_area else 0,
+        'same_crs': len(crs_set) == 1,
+        'same_res': len(res_set) == 1,
+        'crs': next(iter(crs_set)) if len(crs_set) == 1 else None,
+    }
+
+
+def choose_engine(files: List[str], method: str, dst_crs=None) -> Tuple[str, str]:
+    """根据输入特征选择更快的引擎，返回 (引擎, 原因)"""
+    if method == 'feather':
+        return 'windowed', "feather 只有分块引擎支持"
+
+    stats = footprint_stats(files)
+    # 无内置像素函数时 VRT 只能用 Python 像素函数逐块计算，除非必须重投影，否则不选 VRT
+    fallback = method not in ('first', 'last') and not native_pixel_fn_available(method)
+    note = f"（当前 GDAL 无内置 {method} 像素函数，将使用 Python 像素函数）" if fallback else ""
+    if dst_crs and stats['same_crs'] and rasterio.crs.CRS.from_user_input(dst_crs).to_string() != stats['crs']:
+        return 'vrt', "需要重投影，分块引擎不做重投影" + note
+    if not stats['same_crs']:
+        return 'vrt', "输入坐标系不一致，由 gdal.Warp 统一处理" + note
+    if fallback:
+        return 'windowed', f"当前 GDAL 无内置 {method} 像素函数，VRT 会回退到 Python 像素函数"
+    if not stats['same_res']:
+        return 'vrt', "输入分辨率不一致，由 gdal.Warp 重采样"
+    summary = (f"{stats['files']} 个文件，重叠面积占比 {stats['overlap_ratio']:.1%}，"
+               f"最大重叠深度 {stats['max_depth']}")
+    if stats['files'] <= VRT_MAX_FILES and stats['overlap_ratio'] <= VRT_MAX_OVERLAP:
+        return 'vrt', summary
+    return 'windowed', summary
+
+
+def merge(files: List[str],
+          out_path: str,
+          method: str = 'mean',
+          engine: str = 'auto',
+          dst_dtype: str = 'Float32',
+          dst_nodata = None,
+          dst_crs = None,
+          creation_options: List[str] = None,
+          bands: List[int] = None,
+          log = None,
+          progress_cb = None,
+          **kwargs) -> str:
+    """统一入口：engine 为 'auto' 时自动选择，也可强制 'windowed' 或 'vrt'
+
+    kwargs 只传给分块引擎（block_size、n_workers 等），VRT 引擎只使用其中的 target_res 和 resample；
+    设置了 dry_run、aoi、stats 等只有分块引擎支持的参数时，auto 选择分块引擎，强制 vrt 则报错。
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unsupported engine: {engine}")
+    windowed_only = windowed_only_options(kwargs)
+    if engine == 'vrt' and windowed_only:
+        raise ValueError(f"Unsupported options for vrt engine: {', '.join(windowed_only)}")
+    files = expand_inputs(files)
+    if engine == 'auto':
+        if windowed_only:
+            engine, reason = 'windowed', f"{', '.join(windowed_only)} 只有分块引擎支持"
+        else:
+            engine, reason = choose_engine(files, method, dst_crs)
+        if log:
+            log(f"引擎选择: {engine}（{reason}）")
+    elif log:
+        log(f"引擎选择: {engine}（手动指定）")
+
+    if engine == 'windowed':
+        return mosaic_overlap(files, out_path,
+                              method=method,
+                              dst_dtype=dst_dtype,
+                              dst_nodata=dst_nodata,
+                              dst_crs=dst_crs,
+                              creation_options=creation_options,
+                              bands=bands,
+                              log=log,
+                              progress_cb=progress_cb,
+                              **kwargs)
+
+    if creation_options is None:
+        creation_options = ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES']
+    vrt_path = f"{out_path}.vrt"
+    used, nodata = build_merge_vrt(vrt_path, files, method, bands=bands)
+    if log:
+        log(f"VRT 融合方式: {PIXEL_FN_DESC[used]}")
+    opts = {
+        'multithread': True,
+        'creationOptions': creation_options,
+        'outputType': gdal.GetDataTypeByName(dst_dtype),
+        'dstNodata': dst_nodata if dst_nodata is not None else nodata,
+    }
+    if dst_crs:
+        opts['dstSRS'] = dst_crs
+    # 指定输出分辨率时 gdal.Warp 同样会从源概视图读取
+    target_res = kwargs.get('target_res')
+    if target_res is not None:
+        opts['xRes'], opts['yRes'] = (target_res, target_res) if isinstance(target_res, (int, float)) else target_res
+        opts['resampleAlg'] = kwargs.get('resample', 'nearest')
+
+    def _progress(pct, msg, data):
+        if progress_cb:
+            progress_cb(int(pct * 100))
+        return 1
+
+    warp_merged_vrt(vrt_path, out_path, opts, used, callback=_progress)
+    os.remove(vrt_path)
+    return out_path
@@ -1,17 +1,46 @@
 # mosaic_overlap.py
 import os
-from typing import List, Tuple
+import json
+from typing import List, Tuple, Union
 import numpy as np
 import rasterio
 from rasterio.windows import Window
 from rasterio.transform import from_bounds
-from rasterio.enums import Resampling
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from rasterio.enums import Resampling, MaskFlags
+from rasterio.warp import transform_geom
+from affine import Affine
+import rasterio.features
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from rtree import index
 from osgeo import gdal
 import gc
+import time
+from collections import Counter, OrderedDict
+import shutil
+import tempfile
+import threading
+from archive_inputs import expand_inputs
 gdal.SetCacheMax(100 * 1024 * 1024)  # 100MB
 
+# feather 权重在降采样网格上计算，长边不超过该像素数
+FEATHER_MAX_SIZE = 1024
+# 每个源文件的低分辨率距离权重缓存：(path, 大小, 修改时间) -> (weights, scale_y, scale_x)，按字节数 LRU 淘汰
+FEATHER_CACHE_BYTES = 256 * 1024 * 1024
+_feather_cache = OrderedDict()
+_feather_bytes = 0
+_feather_lock = threading.Lock()
+# 整幅全有效的源：(path, 大小, 修改时间) -> bool
+_all_valid_cache = {}
+_mask_lock = threading.Lock()
+# 有效性位图的长边格数上限
+VALIDITY_MAX_SIZE = 256
+# 窗口派发顺序
+WINDOW_ORDERS = ('row', 'hilbert', 'zorder')
+# 瓦片输出不支持的参数及其默认值：设置为非默认值时报错，不静默忽略
+TILE_UNSUPPORTED = {'dry_run': False, 'memory_limit': None, 'aoi': None, 'stats': False,
+                    'memmap_dir': None, 'prefetch_depth': 0, 'shard_count': 1,
+                    'window_order': 'hilbert', 'cache_mb_per_worker': None}
+
 # 类型映射
 dtype_map = {
     "Byte": 'uint8', "Int16": 'int16', "UInt16": 'uint16',
@@ -32,47 +61,495 @@ resample_map = {
     "sum": Resampling.sum
 }
 
-def build_rtree_index(files: List[str]) -> Tuple[index.Index, List[str]]:
-    rtree_idx = index.Index()
-    paths = []
-    for fid, f in enumerate(files):
-        with rasterio.open(f) as src:
-            bounds = src.bounds
-            rtree_idx.insert(fid, (bounds.left, bounds.bottom, bounds.right, bounds.top))
-            paths.append(f)
-    return rtree_idx, paths
-
-def process_window_rtree(rtree_idx, paths, out_win, out_transform, method, dst_nodata,dtype):
+def _read_header(f):
+    with rasterio.open(f) as src:
+        return src.bounds, src.res, (src.crs, src.count, src.dtypes[0], src.nodata)
+
+
+def scan_headers(files: List[str], n_threads: int = 8):
+    """并发读取各源的头信息，返回 (bounds_list, resolutions, layouts)"""
+    if len(files) < 2 * n_threads:
+        headers = [_read_header(f) for f in files]
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            headers = list(pool.map(_read_header, files, chunksize=64))
+    return [h[0] for h in headers], [h[1] for h in headers], [h[2] for h in headers]
+
+
+class FootprintIndex:
+    """源影像外包框索引：R-tree 流式批量构建，外包框存于 (n, 4) 数组
+
+    按窗口行查询候选源并缓存，同一行的相邻窗口只需在该行结果上做数组过滤。
+    同时保留 intersection / count 接口，可直接替代 rtree.index.Index。
+    """
+
+    def __init__(self, boxes, row_cache: int = 64):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        # 流式装载（STR 批量构建）比逐条 insert 快得多，树也更紧凑
+        self._rtree = index.Index((i, tuple(b), None) for i, b in enumerate(self.boxes.tolist()))
+        self.extent = (self.boxes[:, 0].min(), self.boxes[:, 1].min(),
+                       self.boxes[:, 2].max(), self.boxes[:, 3].max()) if len(self.boxes) else None
+        self._row_cache_size = row_cache
+        self._rows = OrderedDict()   # (下边界, 上边界) -> 该行候选源序号（升序）
+        self._lock = threading.Lock()
+        self.validity = {}           # 源序号 -> (位图, 左, 上, 格宽, 格高)，只记录含无效区的源
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def intersection(self, bounds):
+        return self._rtree.intersection(bounds)
+
+    def count(self, bounds) -> int:
+        return len(self.candidates(bounds))
+
+    def _row(self, bottom, top):
+        """一行窗口的候选源，按左边界排序，返回 (序号, 左边界, 最大宽度)"""
+        key = (bottom, top)
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._rows.move_to_end(key)
+                return row
+        left, _, right, _ = self.extent
+        ids = np.fromiter(self._rtree.intersection((left, bottom, right, top)), dtype=np.int64)
+        b = self.boxes[ids]
+        ids = ids[(b[:, 1] < top) & (b[:, 3] > bottom)]
+        lefts = self.boxes[ids, 0]
+        order = np.argsort(lefts, kind='stable')
+        widths = self.boxes[ids, 2] - lefts
+        row = (ids[order], lefts[order], widths.max() if len(ids) else 0.0)
+        with self._lock:
+            self._rows[key] = row
+            if len(self._rows) > self._row_cache_size:
+                self._rows.popitem(last=False)
+        return row
+
+    def candidates(self, bounds) -> np.ndarray:
+        """与范围有正面积重叠的源序号（升序，保证 first / last 的顺序与输入一致）"""
+        left, bottom, right, top = bounds
+        ids, lefts, max_width = self._row(bottom, top)
+        # 左边界有序：只需检查左边界落在 (left - 最大宽度, right) 内的一段
+        lo = np.searchsorted(lefts, left - max_width, side='left')
+        hi = np.searchsorted(lefts, right, side='left')
+        ids = ids[lo:hi]
+        ids = np.sort(ids[self.boxes[ids, 2] > left])
+        if self.validity:
+            keep = np.fromiter((self._touches_valid(fid, bounds) for fid in ids.tolist()),
+                               dtype=bool, count=len(ids))
+            ids = ids[keep]
+        return ids
+
+    def _touches_valid(self, fid: int, bounds) -> bool:
+        """源的有效区（粗分辨率位图）是否触及该范围；没有位图的源按外包框处理"""
+        entry = self.validity.get(fid)
+        if entry is None:
+            return True
+        bitmap, left, top, cell_w, cell_h = entry
+        n_rows, n_cols = bitmap.shape
+        # 范围覆盖的位图格，边界略向外放宽，避免浮点误差漏掉相邻格
+        c0 = max(0, int(np.floor((bounds[0] - left) / cell_w - 1e-6)))
+        c1 = min(n_cols, int(np.ceil((bounds[2] - left) / cell_w + 1e-6)))
+        r0 = max(0, int(np.floor((top - bounds[3]) / cell_h - 1e-6)))
+        r1 = min(n_rows, int(np.ceil((top - bounds[1]) / cell_h + 1e-6)))
+        return c1 > c0 and r1 > r0 and bool(bitmap[r0:r1, c0:c1].any())
+
+    def load_validity(self, paths: List[str], n_threads: int = 8) -> int:
+        """为含 nodata / 掩膜的源建立有效性位图，此后 candidates 剔除有效区不触及范围的源
+
+        返回建立了位图的源数。
+        """
+        with ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+            entries = list(pool.map(_coarse_validity, paths))
+        self.validity = {fid: e for fid, e in enumerate(entries) if e is not None}
+        with self._lock:
+            self._rows.clear()
+        return len(self.validity)
+
+
+def _coarse_validity(path: str):
+    """源有效区的粗分辨率位图，返回 (位图, 左, 上, 格宽, 格高)；整幅有效或无法读取时返回 None
+
+    一格内只要有一个有效像素即记为有效，只会多保留候选，不会误删有数据的源。
+    """
+    try:
+        with rasterio.open(path) as src:
+            entry = None
+            if not _source_all_valid(src, path):
+                h, w = src.height, src.width
+                cell = max(1, int(np.ceil(max(h, w) / VALIDITY_MAX_SIZE)))
+                n_rows, n_cols = -(-h // cell), -(-w // cell)
+                bitmap = np.zeros((n_rows, n_cols), dtype=bool)
+                # 按整格的行条带读取掩膜波段（或 nodata 推出的掩膜），逐格取 any
+                step = cell * max(1, 512 // cell)
+                for row in range(0, h, step):
+                    n = min(step, h - row)
+                    k = -(-n // cell)
+                    padded = np.zeros((k * cell, n_cols * cell), dtype=bool)
+                    padded[:n, :w] = src.dataset_mask(window=Window(0, row, w, n)) > 0
+                    bitmap[row // cell:row // cell + k] = padded.reshape(k, cell, n_cols, cell).any(axis=(1, 3))
+                entry = (bitmap, src.bounds.left, src.bounds.top, cell * src.res[0], cell * src.res[1])
+    except Exception:
+        return None
+    return entry
+
+
+def build_rtree_index(files: List[str], bounds_list=None) -> Tuple[FootprintIndex, List[str]]:
+    """建立源外包框索引；已做过表头扫描时传入 bounds_list，不再重复打开文件"""
+    if bounds_list is None:
+        bounds_list = scan_headers(files)[0]
+    boxes = [(b.left, b.bottom, b.right, b.top) for b in bounds_list]
+    return FootprintIndex(boxes), list(files)
+
+
+class _SourceHandles:
+    """每个线程各自缓存打开的源数据集（rasterio 数据集不能跨线程并发读取），超出上限按 LRU 关闭"""
+
+    def __init__(self, paths: List[str], max_open: int = 64):
+        self._paths = paths
+        self._max_open = max_open
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._live = set()  # 各线程当前打开的数据集，close() 时统一关闭；被 LRU 淘汰的随即移除
+
+    def get(self, fid: int):
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = OrderedDict()
+        src = cache.get(fid)
+        if src is not None:
+            cache.move_to_end(fid)
+            return src
+        src = rasterio.open(self._paths[fid])
+        cache[fid] = src
+        old = cache.popitem(last=False)[1] if len(cache) > self._max_open else None
+        with self._lock:
+            self._live.add(src)
+            if old is not None:
+                self._live.discard(old)
+        if old is not None:
+            old.close()
+        return src
+
+    def close(self):
+        with self._lock:
+            for src in self._live:
+                if not src.closed:
+                    src.close()
+            self._live = set()
+
+
+def _feather_weights(src, path):
+    """计算（或从缓存取出）源文件到有效区边缘的距离权重，低分辨率网格"""
+    global _feather_bytes
+    key = _file_key(path)
+    with _feather_lock:
+        cached = _feather_cache.get(key)
+        if cached is not None:
+            _feather_cache.move_to_end(key)
+            return cached
+
+    scale = max(1.0, max(src.height, src.width) / FEATHER_MAX_SIZE)
+    lh = max(1, int(round(src.height / scale)))
+    lw = max(1, int(round(src.width / scale)))
+    scale_y = src.height / lh
+    scale_x = src.width / lw
+
+    # 数据集掩膜（nodata / 掩膜波段 / alpha）作为有效区，外围补一圈 0，使影像边界也算作边缘
+    valid = src.dataset_mask(out_shape=(lh, lw), resampling=Resampling.nearest) > 0
+    padded = np.zeros((lh + 2, lw + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = valid
+
+    mem = gdal.GetDriverByName('MEM')
+    mask_ds = mem.Create('', lw + 2, lh + 2, 1, gdal.GDT_Byte)
+    mask_ds.GetRasterBand(1).WriteArray(padded)
+    prox_ds = mem.Create('', lw + 2, lh + 2, 1, gdal.GDT_Float32)
+    gdal.ComputeProximity(mask_ds.GetRasterBand(1), prox_ds.GetRasterBand(1),
+                          ['VALUES=0', 'DISTUNITS=PIXEL'])
+    dist = prox_ds.GetRasterBand(1).ReadAsArray()[1:-1, 1:-1].astype('float32')
+    mask_ds = None
+    prox_ds = None
+
+    # 换算成地图单位，保证不同分辨率的源之间权重可比
+    dist *= min(src.res[0] * scale_x, src.res[1] * scale_y)
+    dist[~valid] = 0
+
+    entry = (dist, scale_y, scale_x)
+    with _feather_lock:
+        if key not in _feather_cache:
+            _feather_cache[key] = entry
+            _feather_bytes += dist.nbytes
+            while _feather_bytes > FEATHER_CACHE_BYTES and len(_feather_cache) > 1:
+                _, old = _feather_cache.popitem(last=False)
+                _feather_bytes -= old[0].nbytes
+    return entry
+
+
+def clear_feather_cache():
+    """清空距离权重缓存，每次拼接结束时调用，长期运行的进程（GUI）不保留上一次的权重"""
+    global _feather_bytes
+    with _feather_lock:
+        _feather_cache.clear()
+        _feather_bytes = 0
+
+
+def _window_feather_weights(src, path, src_window, h, w):
+    """把低分辨率权重双线性上采样到输出窗口"""
+    weights, scale_y, scale_x = _feather_weights(src, path)
+    lh, lw = weights.shape
+
+    # 窗口像素中心在低分辨率网格中的坐标（源窗口与输出尺寸不同时按比例换算）
+    step_y, step_x = src_window.height / h, src_window.width / w
+    rows = (src_window.row_off + (np.arange(h) + 0.5) * step_y) / scale_y - 0.5
+    cols = (src_window.col_off + (np.arange(w) + 0.5) * step_x) / scale_x - 0.5
+    inside_r = (rows > -0.5) & (rows < lh - 0.5)
+    inside_c = (cols > -0.5) & (cols < lw - 0.5)
+    rows = np.clip(rows, 0, lh - 1)
+    cols = np.clip(cols, 0, lw - 1)
+
+    r0 = np.floor(rows).astype(np.intp)
+    c0 = np.floor(cols).astype(np.intp)
+    r1 = np.minimum(r0 + 1, lh - 1)
+    c1 = np.minimum(c0 + 1, lw - 1)
+    fy = (rows - r0)[:, None].astype('float32')
+    fx = (cols - c0)[None, :].astype('float32')
+
+    top = weights[np.ix_(r0, c0)] * (1 - fx) + weights[np.ix_(r0, c1)] * fx
+    bottom = weights[np.ix_(r1, c0)] * (1 - fx) + weights[np.ix_(r1, c1)] * fx
+    out = top * (1 - fy) + bottom * fy
+    out[~inside_r, :] = 0
+    out[:, ~inside_c] = 0
+    return out
+
+
+def _file_key(path: str):
+    """缓存键：路径 + 大小 + 修改时间，同一路径的文件被改写后旧缓存不再命中"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        # VSI 路径等无法直接 stat，只按路径区分
+        return (path, None, None)
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+def _source_all_valid(src, path):
+    """源文件没有 nodata / 掩膜 / alpha 时，整幅都视为有效"""
+    key = _file_key(path)
+    with _mask_lock:
+        flag = _all_valid_cache.get(key)
+    if flag is None:
+        flag = all(flags == [MaskFlags.all_valid] for flags in src.mask_flag_enums)
+        with _mask_lock:
+            _all_valid_cache[key] = flag
+    return flag
+
+
+def _window_inside(src, src_window) -> bool:
+    """源窗口是否完全落在源影像内；完全在内时可不用 boundless 读取"""
+    return (src_window.row_off >= 0 and src_window.col_off >= 0
+            and src_window.row_off + src_window.height <= src.height
+            and src_window.col_off + src_window.width <= src.width)
+
+
+def _scaled_valid_mask(src, path, src_window, h, w):
+    """源分辨率与输出不同时，按输出尺寸重采样得到有效像素掩膜"""
+    # 输出像素中心落在源影像范围内才算覆盖
+    rows = src_window.row_off + (np.arange(h) + 0.5) * src_window.height / h
+    cols = src_window.col_off + (np.arange(w) + 0.5) * src_window.width / w
+    inside = ((rows >= 0) & (rows < src.height))[:, None] & ((cols >= 0) & (cols < src.width))[None, :]
+    if not inside.any() or _source_all_valid(src, path):
+        return inside
+    # 与数据读取一致：窗口完全落在源内时走普通读取，掩膜同样可以使用概视图
+    mask = src.dataset_mask(window=src_window, out_shape=(h, w),
+                            boundless=not _window_inside(src, src_window),
+                            resampling=Resampling.nearest) > 0
+    return mask & inside
+
+
+def _valid_mask(src, path, src_window, h, w, scaled=False):
+    """返回窗口内该源的有效像素布尔掩膜 (h, w)，所有波段共用"""
+    if scaled:
+        return _scaled_valid_mask(src, path, src_window, h, w)
+    # 窗口与源影像实际相交的像素范围
+    roff, coff = int(src_window.row_off), int(src_window.col_off)
+    row0, col0 = max(0, roff), max(0, coff)
+    row1, col1 = min(src.height, roff + h), min(src.width, coff + w)
+    mask = np.zeros((h, w), dtype=bool)
+    if row1 <= row0 or col1 <= col0:
+        return mask
+    r_in = slice(row0 - roff, row1 - roff)
+    c_in = slice(col0 - coff, col1 - coff)
+
+    if _source_all_valid(src, path):
+        mask[r_in, c_in] = True
+    else:
+        mask[r_in, c_in] = src.dataset_mask(window=Window(col0, row0, col1 - col0, row1 - row0)) > 0
+    return mask
+
+
+def _check_bands(bands, src_bands: int) -> List[int]:
+    """校验波段号（从 1 开始），None 表示全部波段"""
+    if not bands:
+        return list(range(1, src_bands + 1))
+    bands = [int(b) for b in bands]
+    bad = [b for b in bands if b < 1 or b > src_bands]
+    if bad:
+        raise ValueError(f"Invalid band index {bad}, input has {src_bands} bands")
+    return bands
+
+
+def _same_res(src, out_transform):
+    """源分辨率与输出网格一致时可直接按像素裁剪"""
+    return (np.isclose(src.res[0], abs(out_transform.a), rtol=1e-6)
+            and np.isclose(src.res[1], abs(out_transform.e), rtol=1e-6))
+
+
+class _WindowBuffers:
+    """每个工作线程复用的窗口读取缓冲区，按 (候选序号, 波段数, 类型) 分配一次后反复使用
+
+    只能用于读取后立即归约的场景；预读流水线会跨窗口持有数组，不能共用缓冲区。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, k: int, n_bands: int, h: int, w: int, dtype):
+        bufs = getattr(self._local, 'bufs', None)
+        if bufs is None:
+            bufs = self._local.bufs = {}
+        key = (k, n_bands, np.dtype(dtype).str)
+        buf = bufs.get(key)
+        if buf is None or buf.shape[1] < h or buf.shape[2] < w:
+            buf = bufs[key] = np.empty((n_bands, max(h, buf.shape[1] if buf is not None else 0),
+                                        max(w, buf.shape[2] if buf is not None else 0)), dtype=dtype)
+        return buf[:, :h, :w]
+
+
+def _read_source(src, path, win_bounds, h, w, out_transform, method, bands: List[int] = None,
+                 resampling=Resampling.nearest, out: np.ndarray = None):
+    """从已打开的源读取一个输出窗口，返回 (arr, valid, weight)；窗口内无有效像素时返回 None
+
+    out 为可复用的 (波段数, h, w) 缓冲区，None 时新分配。源外的部分不填充，由 valid 掩膜排除。
+    """
+    n = len(bands) if bands else src.count
+    scaled = not _same_res(src, out_transform)
+    if scaled:
+        src_window = src.window(*win_bounds)
+    else:
+        src_window = src.window(*win_bounds).round_offsets().round_lengths()
+    # 先判断有效像素，只有 nodata 的源不解码数据
+    valid = _valid_mask(src, path, src_window, h, w, scaled)
+    if not valid.any():
+        return None
+    arr = out if out is not None else np.empty((n, h, w), dtype=src.dtypes[0])
+
+    if scaled:
+        # 分辨率不同时按输出尺寸重采样读取，GDAL 会自动选用合适的概视图层级
+        # 窗口完全落在源内时走普通读取，避免 boundless 经过 VRT 绕开概视图
+        src.read(indexes=bands,
+                 window=src_window,
+                 out=arr,
+                 boundless=not _window_inside(src, src_window),
+                 resampling=resampling)
+    else:
+        # 只读取源与窗口精确相交的部分，直接写入缓冲区对应位置，不经过 boundless 的临时 VRT
+        roff, coff = int(src_window.row_off), int(src_window.col_off)
+        row0, col0 = max(0, roff), max(0, coff)
+        row1, col1 = min(src.height, roff + h), min(src.width, coff + w)
+        src.read(indexes=bands, # 只读取所需波段
+                 window=Window(col0, row0, col1 - col0, row1 - row0),
+                 out=arr[:, row0 - roff:row1 - roff, col0 - coff:col1 - coff])
+    weight = _window_feather_weights(src, path, src_window, h, w) if method == 'feather' else None
+    return arr, valid, weight
+
+
+def _window_candidates(rtree_idx, win_bounds):
+    """窗口的候选源序号（升序，保证 first / last 的顺序与输入文件顺序一致）"""
+    if isinstance(rtree_idx, FootprintIndex):
+        return rtree_idx.candidates(win_bounds)
+    return sorted(rtree_idx.intersection(win_bounds))
+
+
+def _read_window_sources(rtree_idx, paths, out_win, out_transform, method, bands: List[int] = None,
+                         resampling=Resampling.nearest, with_ids: bool = False, handles=None,
+                         buffers=None, block_stats=None):
+    """读取窗口内全部候选源，返回 (arrays, masks, weights)，供归约阶段使用
+
+    with_ids 为 True 时额外在最前面返回各数组对应的源序号，用于按组归约；
+    传入 handles（_SourceHandles）时复用各线程已打开的源数据集，
+    传入 buffers（_WindowBuffers）时读入各线程预分配的缓冲区，
+    传入 block_stats（BlockCacheStats）时记录读取涉及的源数据块。
+    """
     win_bounds = rasterio.windows.bounds(out_win, out_transform)
     h, w = out_win.height, out_win.width
-    candidate_ids = list(rtree_idx.intersection(win_bounds))
+    candidate_ids = _window_candidates(rtree_idx, win_bounds)
+    ids = []
     arrays = []
-
-    if not candidate_ids:
-        return np.full((1, h, w), dst_nodata, dtype=dtype)
+    masks = []
+    weights = []
 
     for fid in candidate_ids:
-        with rasterio.open(paths[fid]) as src:
-            try:
-                src_window = src.window(*win_bounds).round_offsets().round_lengths()
-                arr = src.read(window=src_window,
-                               boundless=True,
-                               fill_value=dst_nodata)
-                            #    resampling=resample)
-                arr = arr[:, :h, :w]
-                arrays.append(arr)
-            except Exception:
-                continue
+        try:
+            if handles is not None:
+                src = handles.get(fid)
+                out = buffers.get(len(arrays), len(bands) if bands else src.count, h, w,
+                                  src.dtypes[0]) if buffers is not None else None
+                read = _read_source(src, paths[fid], win_bounds, h, w, out_transform,
+                                    method, bands, resampling, out)
+                # 只统计真正解码了数据的读取（无有效像素的源在读数据前已跳过）
+                if block_stats is not None and read is not None:
+                    block_stats.touch(fid, src, win_bounds, len(bands) if bands else src.count,
+                                      scaled=not _same_res(src, out_transform))
+            else:
+                with rasterio.open(paths[fid]) as src:
+                    out = buffers.get(len(arrays), len(bands) if bands else src.count, h, w,
+                                      src.dtypes[0]) if buffers is not None else None
+                    read = _read_source(src, paths[fid], win_bounds, h, w, out_transform,
+                                        method, bands, resampling, out)
+                    if block_stats is not None and read is not None:
+                        block_stats.touch(fid, src, win_bounds, len(bands) if bands else src.count,
+                                          scaled=not _same_res(src, out_transform))
+        except Exception:
+            continue
+        if read is None:
+            continue
+        arr, valid, weight = read
+        ids.append(fid)
+        arrays.append(arr)
+        masks.append(valid)
+        if weight is not None:
+            weights.append(weight)
+    if with_ids:
+        return ids, arrays, masks, weights
+    return arrays, masks, weights
+
 
+def _reduce_window(arrays, masks, weights, h, w, method, dst_nodata, dtype, n_bands=1):
+    """把各源的窗口数据按 method 归约为输出数组 (bands, h, w)"""
     if not arrays:
-        return np.full((1, h, w), dst_nodata, dtype=dtype)
+        return np.full((n_bands, h, w), dst_nodata, dtype=dtype)
 
     stacked = np.stack(arrays, axis=0)  # shape: (n_files, bands, h, w)
-    bands = stacked.shape[1]
-    output = np.empty((bands, h, w), dtype=dtype)
+    valid = np.stack(masks, axis=0)  # shape: (n_files, h, w)，True 表示有效值
+    invalid = ~valid
+    any_valid = valid.any(axis=0)
+    out_bands = stacked.shape[1]
+    output = np.empty((out_bands, h, w), dtype=dtype)
+    if method == 'feather':
+        stacked_weights = np.stack(weights, axis=0)  # shape: (n_files, h, w)
+        # 有效像素至少保留一个极小权重
+        wts = np.where(valid, np.maximum(stacked_weights, 1e-6), 0)
+        wsum = wts.sum(axis=0)
+    elif method in ('first', 'last'):
+        # argmax 返回第一个 True 的索引
+        if method == 'first':
+            idx = valid.argmax(axis=0)  # shape: (h, w)
+        else:
+            idx = len(arrays) - 1 - np.flip(valid, axis=0).argmax(axis=0)
+        idx = idx[None]
 
-    for b in range(bands):
-        band_data = np.ma.masked_equal(stacked[:, b, :], dst_nodata)
+    for b in range(out_bands):
+        band_data = np.ma.masked_array(stacked[:, b], mask=invalid)
         if method == 'mean':
             output[b] = np.ma.mean(band_data, axis=0).filled(dst_nodata)
         elif method == 'max':
@@ -81,28 +558,682 @@ def process_window_rtree(rtree_idx, paths, out_win, out_transform, method, dst_n
             output[b] = np.ma.min(band_data, axis=0).filled(dst_nodata)
         elif method == 'sum':
             output[b] = np.ma.sum(band_data, axis=0).filled(dst_nodata)
-        elif method == 'first':
-            mask = ~band_data.mask  # shape: (n_files, h, w) -> True 表示有效值
-            # argmax 返回第一个 True 的索引
-            idx = mask.argmax(axis=0)  # shape: (h, w)
-            stacked_data = stacked[:, b, :, :]  # shape: (n_files, h, w)
-            output[b] = np.choose(idx, stacked_data)
-
-        elif method == 'last':
-            mask = ~band_data.mask
-            reversed_mask = np.flip(mask, axis=0)
-            idx = reversed_mask.argmax(axis=0)
-            reversed_data = np.flip(stacked[:, b, :, :], axis=0)
-            output[b] = np.choose(idx, reversed_data)
+        elif method == 'feather':
+            # 按到边缘距离加权平均
+            acc = (np.where(valid, stacked[:, b], 0) * wts).sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                output[b] = np.where(wsum > 0, acc / wsum, dst_nodata)
+        elif method in ('first', 'last'):
+            picked = np.take_along_axis(stacked[:, b], idx, axis=0)[0]
+            output[b] = np.where(any_valid, picked, dst_nodata)
         else:
             raise ValueError(f"Unsupported method: {method}")
-        
-    del arrays
+
     del band_data
     del stacked
+    return output
+
+
+def process_window_rtree(rtree_idx, paths, out_win, out_transform, method, dst_nodata,dtype,
+                         bands: List[int] = None, resampling=Resampling.nearest, handles=None,
+                         buffers=None, block_stats=None):
+    arrays, masks, weights = _read_window_sources(rtree_idx, paths, out_win, out_transform, method, bands,
+                                                  resampling, handles=handles, buffers=buffers,
+                                                  block_stats=block_stats)
+    output = _reduce_window(arrays, masks, weights, out_win.height, out_win.width,
+                            method, dst_nodata, dtype, len(bands) if bands else 1)
+    del arrays
+    del masks
     gc.collect()
     return output
 
+class WindowPrefetcher:
+    """按窗口计划顺序异步预读源数据，预读窗口数和缓冲字节数有上限
+
+    工作线程按序号 get(i) 取数据；取到时已读完记为命中，否则记录等待时间。
+    """
+
+    def __init__(self, fetch, windows, depth: int = 4, max_bytes: int = 256 * 1024 * 1024,
+                 n_threads: int = 2):
+        self._fetch = fetch
+        self._windows = windows
+        self._depth = max(1, depth)
+        self._max_bytes = max_bytes
+        self._pool = ThreadPoolExecutor(max_workers=max(1, n_threads))
+        self._lock = threading.Lock()
+        self._futures = {}      # 窗口序号 -> Future
+        self._started = set()   # 已提交过读取的窗口序号
+        self._sizes = {}        # 已读完未取走的窗口序号 -> 字节数
+        self._next = 0          # 下一个待预读的窗口序号
+        self._buffered_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stall_time = 0.0
+        with self._lock:
+            self._schedule()
+
+    def _fetch_one(self, i):
+        data = self._fetch(self._windows[i])
+        arrays, masks, weights = data
+        nbytes = sum(a.nbytes for a in arrays) + sum(m.nbytes for m in masks) + sum(x.nbytes for x in weights)
+        with self._lock:
+            self._sizes[i] = nbytes
+            self._buffered_bytes += nbytes
+        return data
+
+    def _submit(self, i):
+        self._futures[i] = self._pool.submit(self._fetch_one, i)
+        self._started.add(i)
+
+    def _schedule(self):
+        # 调用方需持有 self._lock
+        while (self._next < len(self._windows)
+               and len(self._futures) < self._depth
+               and self._buffered_bytes < self._max_bytes):
+            if self._next not in self._started:
+                self._submit(self._next)
+            self._next += 1
+
+    def get(self, i):
+        with self._lock:
+            if i not in self._started:
+                # 超出预读范围，立即提交
+                self._submit(i)
+            fut = self._futures[i]
+        if fut.done():
+            hit = True
+            data = fut.result()
+        else:
+            hit = False
+            t0 = time.perf_counter()
+            data = fut.result()
+            stall = time.perf_counter() - t0
+        with self._lock:
+            self._futures.pop(i, None)
+            self._buffered_bytes -= self._sizes.pop(i, 0)
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.stall_time += stall
+            self._schedule()
+        return data
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+class BlockCacheStats:
+    """按 GDAL 块缓存的 LRU 规则模拟源数据块的访问，估算块缓存命中率
+
+    GDAL 不对外提供块缓存的命中统计，这里按源数据块 (源, 块行, 块列) 和缓存容量推算；
+    未命中即该块需要重新解码。重采样读取可能来自概视图，块位置无法对应，只计数不模拟。
+    """
+
+    def __init__(self, capacity_bytes: int):
+        self._capacity = capacity_bytes
+        self._blocks = OrderedDict()  # (源序号, 块行, 块列) -> 字节数
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.scaled = 0  # 未计入命中率的重采样读取次数
+
+    def touch(self, fid: int, src, win_bounds, n_bands: int = 1, scaled: bool = False):
+        """记录一次读取涉及的源数据块，n_bands 为本次读取的波段数，scaled 表示重采样读取"""
+        if scaled:
+            with self._lock:
+                self.scaled += 1
+            return
+        bh, bw = src.block_shapes[0]
+        win = src.window(*win_bounds)
+        row0, col0 = max(0, int(np.floor(win.row_off))), max(0, int(np.floor(win.col_off)))
+        row1 = min(src.height, int(np.ceil(win.row_off + win.height)))
+        col1 = min(src.width, int(np.ceil(win.col_off + win.width)))
+        if row1 <= row0 or col1 <= col0:
+            return
+        # GDAL 按波段缓存数据块，同一位置各波段的块同进同出，按所读波段的总字节数占用容量
+        nbytes = bh * bw * np.dtype(src.dtypes[0]).itemsize * n_bands
+        with self._lock:
+            for br in range(row0 // bh, (row1 - 1) // bh + 1):
+                for bc in range(col0 // bw, (col1 - 1) // bw + 1):
+                    key = (fid, br, bc)
+                    if key in self._blocks:
+                        self._blocks.move_to_end(key)
+                        self.hits += 1
+                        continue
+                    self.misses += 1
+                    self._blocks[key] = nbytes
+                    self._bytes += nbytes
+                    while self._bytes > self._capacity and len(self._blocks) > 1:
+                        _, old = self._blocks.popitem(last=False)
+                        self._bytes -= old
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class BandStats:
+    """逐窗口累计各波段统计量和直方图，输出完成后直接写入，无需再读一遍结果
+
+    各工作线程先算出窗口内的部分结果，再在锁内合并（均值和方差按 Chan 公式合并）。
+    """
+
+    def __init__(self, n_bands: int, dtype, nodata=None, hist_bins: int = 256, hist_range=None):
+        self._dtype = np.dtype(dtype)
+        self._nodata = nodata
+        self._bins = hist_bins
+        self._lock = threading.Lock()
+        self.pixels = 0
+        self.count = np.zeros(n_bands, dtype=np.int64)
+        self.mean = np.zeros(n_bands, dtype=np.float64)
+        self.m2 = np.zeros(n_bands, dtype=np.float64)
+        self.minimum = np.full(n_bands, np.inf)
+        self.maximum = np.full(n_bands, -np.inf)
+        self.hist_range = None
+        self._hist = None
+        # 8/16 位整型按像元值精确计数，结束时再按实际取值范围分桶；其他类型需指定直方图范围
+        self._exact = hist_bins and hist_range is None and self._dtype.kind in 'iu' and self._dtype.itemsize <= 2
+        if self._exact:
+            info = np.iinfo(self._dtype)
+            self._offset = int(info.min)
+            self._hist = np.zeros((n_bands, int(info.max) - int(info.min) + 1), dtype=np.int64)
+        elif hist_bins and hist_range is not None:
+            self.hist_range = (float(hist_range[0]), float(hist_range[1]))
+            self._hist = np.zeros((n_bands, hist_bins), dtype=np.int64)
+
+    def _valid(self, data):
+        valid = np.ones(data.shape, dtype=bool) if self._dtype.kind not in 'fc' else ~np.isnan(data)
+        if self._nodata is not None and not np.isnan(self._nodata):
+            valid &= data != self._nodata
+        return valid
+
+    def update(self, arr):
+        """累计一个窗口的结果 (bands, h, w)"""
+        n_bands = arr.shape[0]
+        count = np.zeros(n_bands, dtype=np.int64)
+        mean = np.zeros(n_bands)
+        m2 = np.zeros(n_bands)
+        vmin = np.full(n_bands, np.inf)
+        vmax = np.full(n_bands, -np.inf)
+        hist = np.zeros_like(self._hist) if self._hist is not None else None
+        for b in range(n_bands):
+            data = arr[b].ravel()
+            vals = data[self._valid(data)]
+            if vals.size == 0:
+                continue
+            v64 = vals.astype(np.float64)
+            count[b] = vals.size
+            mean[b] = v64.mean()
+            m2[b] = ((v64 - mean[b]) ** 2).sum()
+            vmin[b] = v64.min()
+            vmax[b] = v64.max()
+            if self._exact:
+                hist[b] = np.bincount(vals.astype(np.int64) - self._offset, minlength=hist.shape[1])
+            elif hist is not None:
+                hist[b] = np.histogram(v64, bins=self._bins, range=self.hist_range)[0]
+
+        with self._lock:
+            self.pixels += arr.shape[1] * arr.shape[2]
+            total = self.count + count
+            delta = mean - self.mean
+            nz = total > 0
+            ratio = np.divide(count, total, out=np.zeros(n_bands), where=nz)
+            self.m2 += m2 + delta ** 2 * self.count * ratio
+            self.mean += delta * ratio
+            self.count = total
+            self.minimum = np.minimum(self.minimum, vmin)
+            self.maximum = np.maximum(self.maximum, vmax)
+            if hist is not None:
+                self._hist += hist
+
+    def std(self, b: int) -> float:
+        return float(np.sqrt(self.m2[b] / self.count[b])) if self.count[b] else 0.0
+
+    def histogram(self, b: int):
+        """返回 (下界, 上界, 各桶计数)，没有直方图时返回 None"""
+        if self._hist is None or not self.count[b]:
+            return None
+        if not self._exact:
+            return self.hist_range[0], self.hist_range[1], self._hist[b].tolist()
+        # 精确计数按 [最小值 - 0.5, 最大值 + 0.5] 重新分桶，与 gdalinfo -hist 的整型约定一致
+        lo, hi = float(self.minimum[b]) - 0.5, float(self.maximum[b]) + 0.5
+        values = np.arange(self._hist.shape[1]) + self._offset
+        used = self._hist[b] > 0
+        idx = np.floor((values[used] - lo) / (hi - lo) * self._bins).astype(np.intp)
+        idx = np.clip(idx, 0, self._bins - 1)
+        counts = np.bincount(idx, weights=self._hist[b][used], minlength=self._bins)
+        return lo, hi, counts.astype(np.int64).tolist()
+
+    def write(self, path: str) -> None:
+        """把统计量和默认直方图写入输出文件（GTiff 写入同名 .aux.xml）"""
+        ds = gdal.Open(path)
+        if ds is None:
+            raise RuntimeError(f"Failed to open {path} for writing statistics")
+        for b in range(len(self.count)):
+            if not self.count[b]:
+                continue
+            band = ds.GetRasterBand(b + 1)
+            band.SetStatistics(float(self.minimum[b]), float(self.maximum[b]),
+                               float(self.mean[b]), self.std(b))
+            band.SetMetadataItem('STATISTICS_VALID_PERCENT', f"{100.0 * self.count[b] / self.pixels:.4f}")
+            band.SetMetadataItem('STATISTICS_VALID_COUNT', str(int(self.count[b])))
+            hist = self.histogram(b)
+            if hist is not None:
+                band.SetDefaultHistogram(*hist)
+        ds.FlushCache()
+        ds = None
+
+    def summary(self) -> str:
+        return "\n".join(
+            f"[stats] 波段 {b + 1}：有效 {int(self.count[b])}，最小 {self.minimum[b]:g}，最大 {self.maximum[b]:g}，"
+            f"均值 {self.mean[b]:g}，标准差 {self.std(b):g}"
+            for b in range(len(self.count)) if self.count[b])
+
+
+def _is_cancelled(thread_obj=None, cancel_event=None) -> bool:
+    """GUI 线程请求中断或取消事件已置位"""
+    if thread_obj is not None and thread_obj.isInterruptionRequested():
+        return True
+    return cancel_event is not None and cancel_event.is_set()
+
+
+def _completed_until_cancel(futures, is_cancelled):
+    """按完成顺序产出 future；一旦取消，撤销仍在排队的 future，只再产出已完成和正在运行的"""
+    yielded = set()
+    for f in as_completed(futures):
+        yielded.add(f)
+        yield f
+        if is_cancelled():
+            # 已完成但 as_completed 尚未产出的 future 也要产出，否则其结果会丢失；
+            # 被撤销的 future 不会唤醒 as_completed，这里只等待未撤销的
+            rest = [x for x in list(futures) if x not in yielded and not x.cancel()]
+            yield from as_completed(rest)
+            return
+
+
+def _human_bytes(n) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(n) < 1024 or unit == 'TB':
+            return f"{n:.1f}{unit}"
+        n /= 1024
+
+
+def load_aoi(aoi, crs=None):
+    """解析 AOI，返回 (外包框, 面几何列表)
+
+    aoi 可以是 (minx, miny, maxx, maxy)、GeoJSON 几何字典或矢量文件路径；
+    矢量面会被转换到 crs（输入影像坐标系）。外包框 AOI 的面几何列表为空。
+    """
+    if isinstance(aoi, (list, tuple)) and len(aoi) == 4 and all(np.isscalar(v) for v in aoi):
+        minx, miny, maxx, maxy = (float(v) for v in aoi)
+        if minx >= maxx or miny >= maxy:
+            raise ValueError(f"Invalid AOI bounds {aoi}")
+        return (minx, miny, maxx, maxy), []
+
+    if isinstance(aoi, dict):
+        geoms = [aoi.get('geometry', aoi)]
+    elif isinstance(aoi, str):
+        from osgeo import ogr
+        ds = ogr.Open(aoi)
+        if ds is None:
+            raise ValueError(f"Failed to open AOI vector: {aoi}")
+        layer = ds.GetLayer(0)
+        geoms = [json.loads(feat.GetGeometryRef().ExportToJson())
+                 for feat in layer if feat.GetGeometryRef() is not None]
+        srs = layer.GetSpatialRef()
+        if srs is not None and crs is not None:
+            aoi_crs = rasterio.crs.CRS.from_wkt(srs.ExportToWkt())
+            if aoi_crs != crs:
+                geoms = [transform_geom(aoi_crs, crs, g) for g in geoms]
+        ds = None
+    else:
+        raise ValueError(f"Unsupported AOI: {aoi!r}")
+    if not geoms:
+        raise ValueError(f"AOI has no geometry: {aoi!r}")
+
+    boxes = np.array([rasterio.features.bounds(g) for g in geoms])
+    bbox = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+    return tuple(float(v) for v in bbox), geoms
+
+
+def _aoi_sources(aoi, bounds_list, crs, log=None):
+    """载入 AOI 并筛出与其外包框相交的源，返回 (AOI 外包框, 几何列表, 保留的源序号)"""
+    aoi_bounds, aoi_geoms = load_aoi(aoi, crs)
+    ax0, ay0, ax1, ay1 = aoi_bounds
+    keep = [i for i, b in enumerate(bounds_list)
+            if b.left < ax1 and b.right > ax0 and b.bottom < ay1 and b.top > ay0]
+    if not keep:
+        raise ValueError(f"AOI {aoi_bounds} does not intersect any input")
+    if log:
+        log(f"AOI 范围 {aoi_bounds}：保留 {len(keep)}/{len(bounds_list)} 个源")
+    return aoi_bounds, aoi_geoms, keep
+
+
+def _snap_to_aoi(extent, aoi_bounds, res_x, res_y):
+    """把输出范围裁到 AOI 外包框，并对齐到原有像元网格"""
+    left, bottom, right, top = extent
+    ax0, ay0, ax1, ay1 = aoi_bounds
+    left, right = (left + np.floor((max(ax0, left) - left) / res_x) * res_x,
+                   left + np.ceil((min(ax1, right) - left) / res_x) * res_x)
+    top, bottom = (top - np.floor((top - min(ay1, top)) / res_y) * res_y,
+                   top - np.ceil((top - max(ay0, bottom)) / res_y) * res_y)
+    return left, bottom, right, top
+
+
+def _aoi_windows(geoms, windows, out_transform, block_size):
+    """按块栅格化 AOI（接触即算），只保留与面相交的窗口"""
+    n_rows = max(w.row_off for w in windows) // block_size + 1
+    n_cols = max(w.col_off for w in windows) // block_size + 1
+    touched = rasterio.features.geometry_mask(geoms, out_shape=(n_rows, n_cols),
+                                              transform=out_transform * Affine.scale(block_size),
+                                              all_touched=True, invert=True)
+    return [w for w in windows if touched[w.row_off // block_size, w.col_off // block_size]]
+
+
+def _aoi_mask(geoms, win, out_transform):
+    """窗口内落在 AOI 面内的像素掩膜 (h, w)"""
+    return rasterio.features.geometry_mask(geoms, out_shape=(win.height, win.width),
+                                           transform=rasterio.windows.transform(win, out_transform),
+                                           invert=True)
+
+
+def _hilbert_index(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """n x n 网格（n 为 2 的幂）上各点 (x, y) 在 Hilbert 曲线上的序号"""
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    d = np.zeros_like(x)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # 旋转象限，使下一级子曲线方向一致
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return d
+
+
+def _zorder_index(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """Z 序（Morton 码）：按位交错行列号"""
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    d = np.zeros_like(x)
+    bit = 0
+    while (1 << bit) < n:
+        d |= ((x >> bit) & 1) << (2 * bit)
+        d |= ((y >> bit) & 1) << (2 * bit + 1)
+        bit += 1
+    return d
+
+
+def order_windows(windows: List[Window], order: str = 'hilbert') -> List[Window]:
+    """按空间填充曲线重排窗口，相邻派发的窗口在空间上相邻，共享的源数据块留在缓存中被复用
+
+    order 为 'row'（按行）、'hilbert' 或 'zorder'。
+    """
+    if order not in WINDOW_ORDERS:
+        raise ValueError(f"Unsupported window order: {order}")
+    if order == 'row' or len(windows) < 2:
+        return list(windows)
+    rows = np.array([w.row_off for w in windows], dtype=np.int64)
+    cols = np.array([w.col_off for w in windows], dtype=np.int64)
+    # 窗口按块大小对齐，行列号换算成块序号
+    rows = np.unique(rows, return_inverse=True)[1]
+    cols = np.unique(cols, return_inverse=True)[1]
+    n = 1
+    while n <= max(rows.max(), cols.max()):
+        n *= 2
+    key = _hilbert_index(cols, rows, n) if order == 'hilbert' else _zorder_index(cols, rows, n)
+    return [windows[i] for i in np.argsort(key, kind='stable')]
+
+
+def plan_windows(rtree_idx, windows, out_transform, n_bands, src_itemsize, dst_itemsize,
+                 block_size, n_workers, method, prefetch_bytes=0) -> dict:
+    """统计窗口的重叠深度，并估算读写字节数和峰值内存"""
+    depth_hist = Counter()
+    bytes_read = 0
+    bytes_written = 0
+    max_depth = 0
+    res_x, res_y = abs(out_transform.a), abs(out_transform.e)
+    boxes = getattr(rtree_idx, 'boxes', None)
+    for win in windows:
+        wl, wb, wr, wt = rasterio.windows.bounds(win, out_transform)
+        ids = _window_candidates(rtree_idx, (wl, wb, wr, wt))
+        depth = len(ids)
+        depth_hist[depth] += 1
+        max_depth = max(max_depth, depth)
+        pixels = win.height * win.width
+        if boxes is not None and depth:
+            # 与 _read_source 一致，只读取源与窗口相交的部分
+            b = boxes[np.asarray(ids, dtype=np.int64)]
+            ov_w = np.clip(np.minimum(b[:, 2], wr) - np.maximum(b[:, 0], wl), 0, None) / res_x
+            ov_h = np.clip(np.minimum(b[:, 3], wt) - np.maximum(b[:, 1], wb), 0, None) / res_y
+            read_pixels = int(np.minimum(np.round(ov_w) * np.round(ov_h), pixels).sum())
+        else:
+            read_pixels = depth * pixels
+        bytes_read += read_pixels * n_bands * src_itemsize
+        bytes_written += pixels * n_bands * dst_itemsize
+
+    # 单个窗口：各源数组（缓冲区按整窗口分配）+ 堆叠副本 + 掩膜 (+ feather 权重) + 输出
+    px = block_size * block_size
+    per_window = max_depth * px * (2 * n_bands * src_itemsize + 1 + (8 if method == 'feather' else 0))
+    per_window += px * n_bands * (dst_itemsize + 8)  # 输出与单波段归约的临时数组
+    peak = n_workers * per_window + prefetch_bytes + gdal.GetCacheMax()
+
+    return {
+        'windows': len(windows),
+        'empty': depth_hist.get(0, 0),
+        'single': depth_hist.get(1, 0),
+        'overlap': sum(c for d, c in depth_hist.items() if d >= 2),
+        'depth_hist': dict(sorted(depth_hist.items())),
+        'bytes_read': bytes_read,
+        'bytes_written': bytes_written,
+        'peak_memory': peak,
+    }
+
+
+def format_plan(plan: dict) -> str:
+    return (f"[dry-run] 输出 {plan.get('width')}x{plan.get('height')}，窗口 {plan['windows']} 个："
+            f"空 {plan['empty']}，单源 {plan['single']}，重叠 {plan['overlap']}\n"
+            f"[dry-run] 重叠深度分布 {plan['depth_hist']}\n"
+            f"[dry-run] 预计读取 {_human_bytes(plan['bytes_read'])}，"
+            f"写入 {_human_bytes(plan['bytes_written'])}（未压缩），"
+            f"峰值内存约 {_human_bytes(plan['peak_memory'])}")
+
+
+def _grid_aligned(bounds_list, resolutions, layouts, left, top, tol: float = 1e-6) -> bool:
+    """所有输入 CRS、分辨率、波段数和类型一致，且像元网格互相对齐"""
+    crs0, count0, dtype0, _ = layouts[0]
+    res_x, res_y = resolutions[0]
+    for b, r, (crs, count, dt, _) in zip(bounds_list, resolutions, layouts):
+        if crs != crs0 or count != count0 or dt != dtype0:
+            return False
+        if abs(r[0] - res_x) > tol * res_x or abs(r[1] - res_y) > tol * res_y:
+            return False
+        # 左上角相对整幅原点的偏移必须是整像元
+        off_x = (b.left - left) / res_x
+        off_y = (top - b.top) / res_y
+        if abs(off_x - round(off_x)) > 1e-3 or abs(off_y - round(off_y)) > 1e-3:
+            return False
+    return True
+
+
+def _same_nodata(a, b) -> bool:
+    """nodata 值相同（NaN 视为相等）"""
+    if a is None or b is None:
+        return a is None and b is None
+    return a == b or (np.isnan(a) and np.isnan(b))
+
+
+def _overlap_windows(rtree_idx, bounds_list, windows, out_transform):
+    """筛出至少两个源在其中真正重叠（面积大于 0）的窗口"""
+    result = []
+    for win in windows:
+        wl, wb, wr, wt = rasterio.windows.bounds(win, out_transform)
+        # 裁剪到窗口内的源范围
+        clipped = []
+        for fid in rtree_idx.intersection((wl, wb, wr, wt)):
+            b = bounds_list[fid]
+            cl, cb, cr, ct = max(b.left, wl), max(b.bottom, wb), min(b.right, wr), min(b.top, wt)
+            if cr > cl and ct > cb:
+                clipped.append((cl, cb, cr, ct))
+        overlapped = any(
+            min(p[2], q[2]) > max(p[0], q[0]) and min(p[3], q[3]) > max(p[1], q[1])
+            for i, p in enumerate(clipped) for q in clipped[i + 1:])
+        if overlapped:
+            result.append(win)
+    return result
+
+
+def _write_overlap_vrt(files, out_path, rtree_idx, bounds_list, windows, out_transform,
+                       width, height, block_size, method, dst_nodata, dst_crs,
+                       out_dtype, bands, src_bands, n_workers, log=None, progress_cb=None,
+                       cancelled=None) -> str:
+    """零拷贝输出：VRT 直接引用源文件，重叠窗口的归约结果写入稀疏旁路文件并叠加在最上层"""
+    root = os.path.splitext(out_path)[0]
+    overlap = _overlap_windows(rtree_idx, bounds_list, windows, out_transform)
+    if log:
+        log(f"输入网格对齐，零拷贝输出 VRT；重叠窗口 {len(overlap)}/{len(windows)}")
+
+    # 只选部分波段时先用一层 VRT 做波段选择，保证与旁路文件波段一致
+    sources = list(files)
+    if list(bands) != list(range(1, src_bands + 1)):
+        band_vrt = f"{root}.sources.vrt"
+        vrt_ds = gdal.BuildVRT(band_vrt, sources, bandList=bands)
+        vrt_ds = None
+        sources = [band_vrt]
+
+    if overlap:
+        side_path = f"{root}.overlap.tif"
+        # 稀疏 GeoTIFF：未写入的块不占空间，读取时为 nodata，在 VRT 中透明
+        with rasterio.open(side_path, 'w',
+                           driver='GTiff',
+                           dtype=np.dtype(out_dtype).name,
+                           height=height,
+                           width=width,
+                           crs=dst_crs,
+                           transform=out_transform,
+                           nodata=dst_nodata,
+                           tiled=True,
+                           blockxsize=block_size,
+                           blockysize=block_size,
+                           compress='lzw',
+                           num_threads='ALL_CPUS',
+                           sparse_ok=True,
+                           count=len(bands)) as side:
+            with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                future_map = {
+                    pool.submit(process_window_rtree, rtree_idx, files, win, out_transform,
+                                method, dst_nodata, out_dtype, bands): win
+                    for win in overlap
+                }
+                done = 0
+                for f in _completed_until_cancel(future_map, cancelled or (lambda: False)):
+                    side.write(f.result(), window=future_map.pop(f))
+                    done += 1
+                    if progress_cb:
+                        progress_cb(int(done * 100 / len(overlap)))
+                if done < len(overlap):
+                    raise InterruptedError(f"已取消：重叠窗口未全部完成 {side_path}")
+        sources.append(side_path)
+
+    vrt_ds = gdal.BuildVRT(out_path, sources)
+    vrt_ds = None
+    if progress_cb:
+        progress_cb(100)
+    return out_path
+
+
+def with_compress_threads(creation_options: List[str], threads='ALL_CPUS') -> List[str]:
+    """压缩输出时加上 NUM_THREADS，让 GTiff 驱动在后台线程并行压缩数据块"""
+    options = list(creation_options)
+    if not threads:
+        return options
+    keys = {o.split('=')[0].upper() for o in options if '=' in o}
+    compress = next((o.split('=', 1)[1] for o in options if o.upper().startswith('COMPRESS=')), 'LZW')
+    if 'NUM_THREADS' not in keys and compress.upper() != 'NONE':
+        options.append(f'NUM_THREADS={threads}')
+    return options
+
+
+def shard_path(out_path: str, shard_index: int, shard_count: int) -> str:
+    """分片输出文件名，如 out.tif -> out.shard002of008.tif
+
+    分片总是 GeoTIFF，扩展名固定为 .tif；只有合并后的结果使用 out_path 的扩展名（如 .vrt）。
+    """
+    root = os.path.splitext(out_path)[0]
+    return f"{root}.shard{shard_index:03d}of{shard_count:03d}.tif"
+
+
+def assemble_shards(out_path: str,
+                    shard_count: int,
+                    creation_options: List[str] = None,
+                    keep_shards: bool = False,
+                    log = None) -> str:
+    """把各分片拼成最终结果：输出为 .vrt 时直接引用分片，否则经 VRT 复制成单个文件"""
+    shards = [shard_path(out_path, i, shard_count) for i in range(shard_count)]
+    shards = [s for s in shards if os.path.exists(s)]
+    if not shards:
+        raise RuntimeError("未找到任何分片文件")
+
+    if out_path.lower().endswith('.vrt'):
+        gdal.BuildVRT(out_path, shards)
+        if log:
+            log(f"已生成 VRT：{out_path}（{len(shards)} 个分片）")
+        return out_path
+
+    if creation_options is None:
+        creation_options = ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES']
+    vrt_path = f"{out_path}.shards.vrt"
+    vrt_ds = gdal.BuildVRT(vrt_path, shards)
+    vrt_ds = None
+    gdal.Translate(out_path, vrt_path, creationOptions=with_compress_threads(creation_options))
+    os.remove(vrt_path)
+    if not keep_shards:
+        for s in shards:
+            os.remove(s)
+    if log:
+        log(f"分片合并完成：{out_path}（{len(shards)} 个分片）")
+    return out_path
+
+
+def mosaic_sharded(files: List[str],
+                   out_path: str,
+                   shard_count: int,
+                   n_procs: int = None,
+                   log = None,
+                   **kwargs) -> Union[str, dict]:
+    """本机多进程分片拼接：每个分片一个进程，最后合并分片；dry_run 时只返回整幅规划"""
+    n_procs = n_procs or shard_count
+    if kwargs.get('dry_run'):
+        # 分片条带按块行切分，窗口与整幅一致，整幅规划即各分片之和；不启动进程也不合并分片
+        plan = mosaic_overlap(files, out_path, **kwargs)
+        # 每个进程各有自己的线程池和 GDAL 块缓存
+        n_active = min(n_procs, shard_count)
+        plan.update(shards=shard_count, processes=n_active, peak_memory=plan['peak_memory'] * n_active)
+        if log:
+            log(format_plan(plan))
+            log(f"[dry-run] {shard_count} 个分片，{n_active} 个进程同时运行")
+        return plan
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        futures = [pool.submit(mosaic_overlap, files, out_path,
+                               shard_index=i, shard_count=shard_count, **kwargs)
+                   for i in range(shard_count)]
+        for f in as_completed(futures):
+            f.result()
+    return assemble_shards(out_path, shard_count,
+                           creation_options=kwargs.get('creation_options'), log=log)
+
 # 主函数
 def mosaic_overlap(files: List[str],
                    out_path: str,
@@ -114,23 +1245,86 @@ def mosaic_overlap(files: List[str],
                    dst_crs = None,
                    driver: str = 'GTiff',
                    creation_options: List[str] = None,
-                #    resample: str = 'nearest',
+                   resample: str = 'nearest', # 源与输出分辨率不同时的重采样方法
+                   target_res = None, # 输出分辨率，数值或 (x, y)，None 表示使用最细的输入分辨率
                    flush_interval = 100,
+                   bands: List[int] = None, # 需要的波段（从 1 开始），None 表示全部
+                   memmap_dir: str = None, # 本地临时目录，设置后先归约到 memmap 再顺序编码输出
+                   prefetch_depth: int = 0, # 预读窗口数，0 表示不预读
+                   prefetch_bytes: int = 256 * 1024 * 1024, # 预读缓冲区上限（字节）
+                   shard_index: int = 0, # 分片序号（从 0 开始）
+                   shard_count: int = 1, # 分片总数，>1 时只处理本分片条带并写入分片文件
+                   dry_run: bool = False, # 只做规划和资源预估，不读写像素
+                   memory_limit: int = None, # 预估峰值内存上限（字节），超出则拒绝执行
                    log = None,
                    error = None,
                    thread_obj=None,
-                   progress_cb=None):
+                   progress_cb=None,
+                   cancel_event: threading.Event = None, # 置位后停止派发新窗口，已运行的窗口写完后返回
+                   compress_threads = 'ALL_CPUS', # 输出压缩线程数，None 表示单线程压缩
+                   stats: bool = False, # 写出时同步累计各波段统计量和直方图，结束后写入 .aux.xml
+                   hist_bins: int = 256, # 直方图桶数，0 表示不统计直方图
+                   hist_range = None, # 直方图范围 (最小, 最大)，None 时仅 8/16 位整型自动统计
+                   aoi = None, # 感兴趣区：(minx, miny, maxx, maxy)、GeoJSON 几何或矢量文件路径
+                   tile_format: str = None, # 'png' / 'webp'：输出 XYZ 瓦片金字塔（out_path 为目录或 .mbtiles）
+                   zoom_levels = None, # 瓦片缩放级别 (最小, 最大)，None 表示自动
+                   validity_index: bool = False, # 为含 nodata 区的源建立有效性位图，跳过有效区不触及的窗口
+                   window_order: str = 'hilbert', # 窗口派发顺序：'row'、'hilbert' 或 'zorder'
+                   cache_mb_per_worker: int = None, # 每个工作线程分到的 GDAL 块缓存（MB），None 保持默认 100MB
+                   input_cache_dir: str = None, # ASC / PNG 等慢速格式先转成分块 GeoTIFF 缓存到该目录，None 表示不转换
+                   input_cache_bytes: int = 10 * 1024 ** 3): # 转换缓存目录容量上限（字节），超出按最近使用淘汰
+
+    # 瓦片金字塔输出：按需归约并直接切成 Web Mercator 瓦片，不生成中间 GeoTIFF
+    if tile_format or out_path.lower().endswith('.mbtiles'):
+        from tile_export import export_tiles
+        given = dict(dry_run=dry_run, memory_limit=memory_limit, aoi=aoi, stats=stats,
+                     memmap_dir=memmap_dir, prefetch_depth=prefetch_depth, shard_count=shard_count,
+                     window_order=window_order, cache_mb_per_worker=cache_mb_per_worker)
+        unsupported = [k for k, v in TILE_UNSUPPORTED.items() if given[k] not in (None, v)]
+        if unsupported:
+            raise ValueError(f"Unsupported options for tile output: {', '.join(unsupported)}")
+        files = expand_inputs(files)
+        if input_cache_dir:
+            from input_cache import cached_inputs
+            files = cached_inputs(files, input_cache_dir, input_cache_bytes, log, n_workers)
+        min_zoom, max_zoom = zoom_levels or (None, None)
+        return export_tiles(files, out_path, min_zoom, max_zoom,
+                            method=method,
+                            tile_format=tile_format or 'png',
+                            n_workers=n_workers,
+                            bands=bands,
+                            dst_nodata=dst_nodata,
+                            target_res=target_res,
+                            src_resample=resample,
+                            validity_index=validity_index,
+                            log=log,
+                            thread_obj=thread_obj,
+                            progress_cb=progress_cb,
+                            cancel_event=cancel_event)
 
     if creation_options is None:
         creation_options = ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES']
+    # 写线程只提交数据块，压缩由驱动的线程池并行完成
+    creation_options = with_compress_threads(creation_options, compress_threads)
+    if resample not in resample_map:
+        raise ValueError(f"Unsupported resample method: {resample}")
+    resampling = resample_map[resample]
+
+    # 压缩包展开为 /vsizip/、/vsitar/ 等虚拟路径，后续表头扫描、索引和窗口读取直接使用
+    files = expand_inputs(files)
 
     # 读取所有 bounds，获取输出范围和分辨率
-    bounds_list = []
-    resolutions = []
-    for f in files:
-        with rasterio.open(f) as src:
-            bounds_list.append(src.bounds)
-            resolutions.append(src.res)
+    # layouts 为 (crs, 波段数, 数据类型, nodata)，用于判断能否零拷贝输出 VRT
+    bounds_list, resolutions, layouts = scan_headers(files)
+
+    # 感兴趣区：规划阶段就剔除不相交的源，输出网格只覆盖 AOI
+    aoi_geoms = []
+    if aoi is not None:
+        aoi_bounds, aoi_geoms, keep = _aoi_sources(aoi, bounds_list, layouts[0][0], log)
+        files = [files[i] for i in keep]
+        bounds_list = [bounds_list[i] for i in keep]
+        resolutions = [resolutions[i] for i in keep]
+        layouts = [layouts[i] for i in keep]
 
     # 获取图幅边界
     left = min(b.left for b in bounds_list)
@@ -138,15 +1332,42 @@ def mosaic_overlap(files: List[str],
     right = max(b.right for b in bounds_list)
     top = max(b.top for b in bounds_list)
 
-    # 使用最小分辨率（避免错位）
-    res_x = min(r[0] for r in resolutions)
-    res_y = min(r[1] for r in resolutions)
-    width = int(round((right - left) / res_x))
-    height = int(round((top - bottom) / res_y))
+    if target_res is not None:
+        # 指定输出分辨率：各窗口按输出尺寸重采样读取，较粗时直接读源概视图
+        res_x, res_y = (target_res, target_res) if np.isscalar(target_res) else target_res
+        res_x, res_y = float(res_x), float(res_y)
+        if res_x <= 0 or res_y <= 0:
+            raise ValueError(f"Invalid target resolution {target_res}")
+    else:
+        # 使用最小分辨率（避免错位）
+        res_x = min(r[0] for r in resolutions)
+        res_y = min(r[1] for r in resolutions)
+    if aoi is not None:
+        left, bottom, right, top = _snap_to_aoi((left, bottom, right, top), aoi_bounds, res_x, res_y)
+    width = max(1, int(round((right - left) / res_x)))
+    height = max(1, int(round((top - bottom) / res_y)))
     print(left, bottom, right, top, res_x, res_y)
     print(width, height)
     transform = from_bounds(left, bottom, right, top, width, height)
 
+    # 分片模式：按块行把输出网格切成条带，本进程只处理第 shard_index 条
+    if shard_count > 1:
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Invalid shard index {shard_index} for {shard_count} shards")
+        block_rows = (height + block_size - 1) // block_size
+        row0 = block_rows * shard_index // shard_count * block_size
+        row1 = min(block_rows * (shard_index + 1) // shard_count * block_size, height)
+        if row1 <= row0:
+            if log:
+                log(f"分片 {shard_index}/{shard_count} 为空，跳过")
+            return None
+        # 条带起点是块大小的整数倍，窗口划分与整幅处理完全一致
+        transform = rasterio.windows.transform(Window(0, row0, width, row1 - row0), transform)
+        height = row1 - row0
+        out_path = shard_path(out_path, shard_index, shard_count)
+        if log:
+            log(f"分片 {shard_index}/{shard_count}：行 {row0}-{row1}，输出 {out_path}")
+
     # 读取第一个文件，获取 bands 和 dtype、nodata 值、CRS
     with rasterio.open(files[0]) as ref:
         src_bands = ref.count
@@ -154,10 +1375,17 @@ def mosaic_overlap(files: List[str],
         src_nodata = ref.nodata  # 第一个文件的 nodata 值
         src_crs = ref.crs # 第一个文件的 CRS
 
+    # 波段选择，读取时只解码所需波段
+    bands = _check_bands(bands, src_bands)
+
     # 建立 R-tree 索引
-    rtree_idx, paths = build_rtree_index(files)
+    rtree_idx, paths = build_rtree_index(files, bounds_list)
     if log:
             log(f"索引建立完成")
+    if validity_index:
+        n_masked = rtree_idx.load_validity(paths, n_workers)
+        if log:
+            log(f"有效性位图建立完成，{n_masked} 个源含无效区")
     # 构造所有写入窗口
     windows = []
     for row in range(0, height, block_size):
@@ -165,9 +1393,23 @@ def mosaic_overlap(files: List[str],
             win_w = min(block_size, width - col)
             win_h = min(block_size, height - row)
             windows.append(Window(col, row, win_w, win_h))
+    # AOI 为面时去掉完全落在面外的窗口，这些块不读不写，保持为 nodata
+    n_pruned = 0
+    if aoi_geoms:
+        kept = _aoi_windows(aoi_geoms, windows, transform, block_size)
+        n_pruned = len(windows) - len(kept)
+        windows = kept
+        if log:
+            log(f"AOI 剔除 {n_pruned} 个窗口，剩余 {len(windows)} 个")
+
+    # 按空间填充曲线派发窗口，相邻窗口共享的源数据块更可能仍在缓存中
+    windows = order_windows(windows, window_order)
 
     total = len(windows)
     done = 0
+    # memmap 模式下最后还需按条带编码输出
+    encode_rows = list(range(0, height, block_size)) if memmap_dir is not None else []
+    total_steps = total + len(encode_rows)
 
     np_dtype = np.dtype(dtype_map.get(dst_dtype, src_dtype)) # 输出的值类型
 
@@ -176,6 +1418,101 @@ def mosaic_overlap(files: List[str],
     # 设定输出的 CRS
     dst_crs = dst_crs if dst_crs is not None else src_crs
 
+    out_dtype = dtype_map.get(dst_dtype, src_dtype)
+    if aoi_geoms and dst_nodata is None:
+        raise ValueError("Polygon AOI requires a nodata value for pixels outside the polygon")
+
+    # 规划与资源预估：只用头信息和 R-tree，不读像素
+    if dry_run or memory_limit:
+        plan = plan_windows(rtree_idx, windows, transform, len(bands), np.dtype(src_dtype).itemsize,
+                            np_dtype.itemsize, block_size, n_workers, method,
+                            prefetch_bytes if prefetch_depth > 0 else 0)
+        plan.update(width=width, height=height, transform=tuple(transform)[:6], res=(res_x, res_y))
+        if log:
+            log(format_plan(plan))
+        if memory_limit and plan['peak_memory'] > memory_limit:
+            raise MemoryError(f"Predicted peak memory {_human_bytes(plan['peak_memory'])} "
+                              f"exceeds limit {_human_bytes(memory_limit)}")
+        if dry_run:
+            return plan
+
+    # VRT 输出：输入网格对齐时只引用源文件，仅把重叠窗口归约到旁路文件
+    if out_path.lower().endswith('.vrt') and shard_count == 1:
+        if (target_res is None and aoi is None and _grid_aligned(bounds_list, resolutions, layouts, left, top)
+                and dst_crs == src_crs and np.dtype(out_dtype) == np.dtype(src_dtype)
+                and dst_nodata is not None
+                and all(_same_nodata(layout[3], dst_nodata) for layout in layouts)):
+            if stats and log:
+                log("零拷贝 VRT 输出不经过完整归约，未生成统计信息")
+            return _write_overlap_vrt(files, out_path, rtree_idx, bounds_list, windows, transform,
+                                      width, height, block_size, method, dst_nodata, dst_crs,
+                                      out_dtype, bands, src_bands, n_workers, log, progress_cb,
+                                      lambda: _is_cancelled(thread_obj, cancel_event))
+        # 无法零拷贝，完整拼接到同名 GeoTIFF，再用 VRT 包一层
+        vrt_out = out_path
+        out_path = os.path.splitext(out_path)[0] + '.tif'
+        if log:
+            log(f"输入网格或 nodata 与输出不一致，无法零拷贝，先完整拼接到 {out_path}")
+    else:
+        vrt_out = None
+
+    # 慢速格式转换缓存放在规划和零拷贝 VRT 之后：dry run 只用原始表头，零拷贝 VRT 直接引用原始文件，都不触发转换
+    if input_cache_dir:
+        from input_cache import cached_inputs
+        paths = cached_inputs(paths, input_cache_dir, input_cache_bytes, log, n_workers)
+
+    # memmap 累加器：工作线程直接写入各自窗口的切片
+    acc = None
+    scratch = None
+    if memmap_dir is not None:
+        os.makedirs(memmap_dir, exist_ok=True)
+        scratch = tempfile.mkdtemp(prefix='mosaic_', dir=memmap_dir)
+        acc = np.memmap(os.path.join(scratch, 'accumulator.dat'), dtype=np_dtype, mode='w+',
+                        shape=(len(bands), height, width))
+        if n_pruned:
+            # 被 AOI 剔除的窗口不会写入累加器，先整体填充 nodata
+            acc[:] = dst_nodata
+        if log:
+            log(f"memmap 累加器：{scratch}")
+
+    # 各线程复用已打开的源数据集，不再每个窗口重新打开；不预读时读取缓冲区也按线程复用
+    handles = _SourceHandles(paths)
+    buffers = _WindowBuffers() if prefetch_depth <= 0 else None
+    # GDAL 块缓存是进程级的，按工作线程数放大，结束后恢复
+    cache_max = gdal.GetCacheMax()
+    if cache_mb_per_worker:
+        gdal.SetCacheMax(cache_mb_per_worker * n_workers * 1024 * 1024)
+    block_stats = BlockCacheStats(gdal.GetCacheMax())
+
+    # 预读流水线：I/O 线程按窗口顺序提前读取源数据，计算线程只做归约
+    prefetcher = None
+    if prefetch_depth > 0:
+        prefetcher = WindowPrefetcher(
+            lambda win: _read_window_sources(rtree_idx, paths, win, transform, method, bands,
+                                             resampling, handles=handles, block_stats=block_stats),
+            windows, depth=prefetch_depth, max_bytes=prefetch_bytes,
+            n_threads=min(prefetch_depth, n_workers))
+
+    band_stats = BandStats(len(bands), np_dtype, dst_nodata, hist_bins, hist_range) if stats else None
+
+    def compute(i, win):
+        if prefetcher is not None:
+            arrays, masks, weights = prefetcher.get(i)
+            arr = _reduce_window(arrays, masks, weights, win.height, win.width,
+                                 method, dst_nodata, out_dtype, len(bands))
+        else:
+            arr = process_window_rtree(rtree_idx, paths, win, transform, method, dst_nodata,
+                                       out_dtype, bands, resampling, handles, buffers, block_stats)
+        if aoi_geoms:
+            arr[:, ~_aoi_mask(aoi_geoms, win, transform)] = dst_nodata
+        if band_stats is not None:
+            band_stats.update(arr)
+        if acc is None:
+            return arr
+        # memmap 模式：直接写入对应切片，不把数组交回写线程
+        acc[:, win.row_off:win.row_off + win.height, win.col_off:win.col_off + win.width] = arr
+        return None
+
     # 写入文件
     with rasterio.open(out_path, 'w',
                        driver=driver,
@@ -189,33 +1526,28 @@ def mosaic_overlap(files: List[str],
                        blockxsize=block_size,
                        blockysize=block_size,
                        compress='lzw',
-                       count=src_bands, # 输出的波段数
+                       count=len(bands), # 输出的波段数
                        **{k.split('=')[0]: k.split('=')[1] for k in creation_options if '=' in k}) as dst:
 
         try:
             with ThreadPoolExecutor(max_workers=n_workers) as pool:
-                future_map = {
-                    pool.submit(process_window_rtree,
-                                rtree_idx,
-                                paths,
-                                win,
-                                transform,
-                                method,
-                                dst_nodata,
-                                dtype_map.get(dst_dtype, src_dtype),
-                                # resample_map.get(resample)
-                                ): win
-                    for win in windows
-                }
+                future_map = {pool.submit(compute, i, win): win for i, win in enumerate(windows)}
 
                 write_count = 0
-                for f in as_completed(future_map):
-                    if thread_obj and thread_obj.isInterruptionRequested():
-                        os._exit(1)
+                cancel_logged = False
+                # memmap 模式下已完成但尚未编码输出的窗口，取消时先把它们写入目标文件
+                finished = []
+                for f in _completed_until_cancel(future_map, lambda: _is_cancelled(thread_obj, cancel_event)):
+                    if log and not cancel_logged and _is_cancelled(thread_obj, cancel_event):
+                        cancel_logged = True
+                        log("收到取消请求，等待正在处理的窗口完成")
 
                     arr = f.result()
                     win = future_map.pop(f)
-                    dst.write(arr, window=win)
+                    if acc is None:
+                        dst.write(arr, window=win)
+                    else:
+                        finished.append(win)
                     del arr
                     del f
                     del win
@@ -223,7 +1555,7 @@ def mosaic_overlap(files: List[str],
                     # 定期刷新缓存
                     write_count += 1
                     done += 1
-                    if write_count % flush_interval == 0:
+                    if acc is None and write_count % flush_interval == 0:
                         if log:
                             log(f"[flush] 已写入 {write_count} 块，刷新到磁盘")
                         gdal_ds = gdal.Open(out_path, gdal.GA_Update)
@@ -231,13 +1563,443 @@ def mosaic_overlap(files: List[str],
                         gdal_ds = None  # 强制关闭释放内存
 
                     if progress_cb:
-                        progress_cb(int(done * 100 / total))
+                        progress_cb(int(done * 100 / total_steps))
+
+            if prefetcher is not None and log:
+                log(f"[prefetch] 命中率 {prefetcher.hit_rate:.1%}，"
+                    f"等待 {prefetcher.misses} 次共 {prefetcher.stall_time:.2f}s")
+            if log and block_stats.hits + block_stats.misses:
+                log(f"[cache] 源数据块缓存命中率约 {block_stats.hit_rate:.1%}"
+                    f"（{block_stats.misses} 次解码，{block_stats.hits} 次复用）"
+                    + (f"，{block_stats.scaled} 次重采样读取未计入" if block_stats.scaled else ""))
+            elif log and block_stats.scaled:
+                log(f"[cache] {block_stats.scaled} 次读取均为重采样读取，不估算块缓存命中率")
+            if write_count < total:
+                if acc is not None:
+                    for win in sorted(finished, key=lambda w: (w.row_off, w.col_off)):
+                        dst.write(acc[:, win.row_off:win.row_off + win.height,
+                                      win.col_off:win.col_off + win.width], window=win)
+                raise InterruptedError(f"已取消：完成 {write_count}/{total} 块，已写入的块保留在 {out_path}")
+
+            # 顺序编码：按条带把 memmap 写入目标文件
+            if acc is not None:
+                if log:
+                    log("归约完成，开始编码输出")
+                for row in encode_rows:
+                    if _is_cancelled(thread_obj, cancel_event):
+                        raise InterruptedError(f"已取消：编码输出未完成 {out_path}")
+                    win_h = min(block_size, height - row)
+                    dst.write(acc[:, row:row + win_h, :], window=Window(0, row, width, win_h))
+                    done += 1
+                    if progress_cb:
+                        progress_cb(int(done * 100 / total_steps))
 
         except KeyboardInterrupt:
             if error:
                 error("用户中断操作")
             raise
+        except InterruptedError as e:
+            if log:
+                log(str(e))
+            raise
         except Exception as e:
             if error:
                 error(f"处理过程中出现错误：{e}")
-            raise
\ No newline at end of file
+            raise
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            handles.close()
+            clear_feather_cache()
+            if cache_mb_per_worker:
+                gdal.SetCacheMax(cache_max)
+            if acc is not None:
+                del acc
+                shutil.rmtree(scratch, ignore_errors=True)
+
+    # 统计量在归约时已累计完成，这里只写入元数据
+    if band_stats is not None:
+        band_stats.pixels = width * height  # 含被 AOI 剔除的窗口
+        band_stats.write(out_path)
+        if log:
+            log(band_stats.summary())
+
+    if vrt_out is not None:
+        vrt_ds = gdal.BuildVRT(vrt_out, [out_path])
+        vrt_ds = None
+        return vrt_out
+    return out_path
+
+def group_path(out_path: str, key: str) -> str:
+    """每组的输出路径：out_path 含 {group} 时替换，否则在扩展名前加 _组名"""
+    if '{group}' in out_path:
+        return out_path.replace('{group}', key)
+    root, ext = os.path.splitext(out_path)
+    return f"{root}_{key}{ext or '.tif'}"
+
+
+def mosaic_groups(groups: dict,
+                  out_path: str,
+                  method: str = 'mean',
+                  block_size: int = 512,
+                  n_workers: int = 4,
+                  dst_dtype: str = 'float32',
+                  dst_nodata = None,
+                  dst_crs = None,
+                  creation_options: List[str] = None,
+                  resample: str = 'nearest',
+                  target_res = None,
+                  bands: List[int] = None,
+                  log = None,
+                  error = None,
+                  thread_obj=None,
+                  progress_cb=None,
+                  cancel_event: threading.Event = None,
+                  compress_threads = 'ALL_CPUS',
+                  validity_index: bool = False,
+                  window_order: str = 'hilbert',
+                  input_cache_dir: str = None,
+                  input_cache_bytes: int = 10 * 1024 ** 3,
+                  aoi = None,
+                  stats: bool = False,
+                  hist_bins: int = 256,
+                  hist_range = None,
+                  dry_run: bool = False) -> dict:
+    """一次处理多组合成（如逐日 / 逐月），返回 {组名: 输出路径}；dry_run 时只返回规划
+
+    所有组共用一次表头扫描、一个 R-tree 和一套窗口规划；每个窗口内每个源只打开读取一次，
+    再按组分别归约并写入各组输出。aoi / stats 的含义与 mosaic_overlap 相同。
+    """
+    if creation_options is None:
+        creation_options = ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES']
+    creation_options = with_compress_threads(creation_options, compress_threads)
+    if resample not in resample_map:
+        raise ValueError(f"Unsupported resample method: {resample}")
+    resampling = resample_map[resample]
+
+    # 合并所有组的源，同一文件只出现一次；记录每个源属于哪些组
+    files = []
+    file_ids = {}
+    for key, members in groups.items():
+        for f in expand_inputs(members):
+            if f not in file_ids:
+                file_ids[f] = len(files)
+                files.append(f)
+    if not files:
+        raise ValueError("No input files in any group")
+    keys = list(groups)
+    group_of = [[] for _ in files]
+    for gi, key in enumerate(keys):
+        for f in expand_inputs(groups[key]):
+            group_of[file_ids[f]].append(gi)
+
+    bounds_list, resolutions, layouts = scan_headers(files)
+    aoi_geoms = []
+    if aoi is not None:
+        aoi_bounds, aoi_geoms, keep = _aoi_sources(aoi, bounds_list, layouts[0][0], log)
+        files = [files[i] for i in keep]
+        group_of = [group_of[i] for i in keep]
+        bounds_list = [bounds_list[i] for i in keep]
+        resolutions = [resolutions[i] for i in keep]
+    left = min(b.left for b in bounds_list)
+    bottom = min(b.bottom for b in bounds_list)
+    right = max(b.right for b in bounds_list)
+    top = max(b.top for b in bounds_list)
+    if target_res is not None:
+        res_x, res_y = (target_res, target_res) if np.isscalar(target_res) else target_res
+    else:
+        res_x = min(r[0] for r in resolutions)
+        res_y = min(r[1] for r in resolutions)
+    if aoi is not None:
+        left, bottom, right, top = _snap_to_aoi((left, bottom, right, top), aoi_bounds, res_x, res_y)
+    width = max(1, int(round((right - left) / res_x)))
+    height = max(1, int(round((top - bottom) / res_y)))
+    transform = from_bounds(left, bottom, right, top, width, height)
+
+    with rasterio.open(files[0]) as ref:
+        src_bands = ref.count
+        src_dtype = ref.dtypes[0]
+        src_nodata = ref.nodata
+        src_crs = ref.crs
+    bands = _check_bands(bands, src_bands)
+    out_dtype = dtype_map.get(dst_dtype, src_dtype)
+    np_dtype = np.dtype(out_dtype)
+    dst_nodata = dst_nodata if dst_nodata is not None else src_nodata
+    dst_crs = dst_crs if dst_crs is not None else src_crs
+    if aoi_geoms and dst_nodata is None:
+        raise ValueError("Polygon AOI requires a nodata value for pixels outside the polygon")
+
+    rtree_idx, paths = build_rtree_index(files, bounds_list)
+    if validity_index:
+        rtree_idx.load_validity(paths, n_workers)
+    windows = []
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            windows.append(Window(col, row, min(block_size, width - col), min(block_size, height - row)))
+    if aoi_geoms:
+        windows = _aoi_windows(aoi_geoms, windows, transform, block_size)
+    windows = order_windows(windows, window_order)
+    total = len(windows)
+    if log:
+        log(f"{len(keys)} 组，{len(files)} 个源，输出 {width}x{height}，{total} 个窗口")
+
+    if dry_run:
+        # 源读取各组共享，只有输出按组数放大
+        plan = plan_windows(rtree_idx, windows, transform, len(bands), np.dtype(src_dtype).itemsize,
+                            np_dtype.itemsize, block_size, n_workers, method)
+        plan['bytes_written'] *= len(keys)
+        plan['peak_memory'] += (len(keys) - 1) * n_workers * block_size * block_size * len(bands) * np_dtype.itemsize
+        plan.update(width=width, height=height, transform=tuple(transform)[:6], res=(res_x, res_y),
+                    groups=len(keys))
+        if log:
+            log(format_plan(plan))
+        return plan
+
+    if input_cache_dir:
+        from input_cache import cached_inputs
+        paths = cached_inputs(paths, input_cache_dir, input_cache_bytes, log, n_workers)
+
+    group_stats = [BandStats(len(bands), np_dtype, dst_nodata, hist_bins, hist_range) for _ in keys] if stats else None
+
+    def compute(win):
+        ids, arrays, masks, weights = _read_window_sources(rtree_idx, paths, win, transform, method,
+                                                           bands, resampling, with_ids=True, handles=handles,
+                                                           buffers=buffers)
+        # 源数组按组分配，同一源被多个组引用时共享同一份数据
+        per_group = [([], [], []) for _ in keys]
+        for k, fid in enumerate(ids):
+            for gi in group_of[fid]:
+                per_group[gi][0].append(arrays[k])
+                per_group[gi][1].append(masks[k])
+                if weights:
+                    per_group[gi][2].append(weights[k])
+        # 组内没有有效源的窗口不写，块保持为 nodata
+        out = {gi: _reduce_window(a, m, w, win.height, win.width, method, dst_nodata, out_dtype, len(bands))
+               for gi, (a, m, w) in enumerate(per_group) if a}
+        outside = ~_aoi_mask(aoi_geoms, win, transform) if aoi_geoms else None
+        for gi, arr in out.items():
+            if outside is not None:
+                arr[:, outside] = dst_nodata
+            if group_stats is not None:
+                group_stats[gi].update(arr)
+        return out
+
+    handles = _SourceHandles(paths)
+    buffers = _WindowBuffers()
+    out_paths = {key: group_path(out_path, key) for key in keys}
+    profile = dict(driver='GTiff', dtype=np_dtype.name, height=height, width=width, crs=dst_crs,
+                   transform=transform, nodata=dst_nodata, tiled=True, blockxsize=block_size,
+                   blockysize=block_size, compress='lzw', count=len(bands),
+                   **{k.split('=')[0]: k.split('=')[1] for k in creation_options if '=' in k})
+    dsts = []
+    try:
+        for key in keys:
+            dsts.append(rasterio.open(out_paths[key], 'w', **profile))
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            future_map = {pool.submit(compute, win): win for win in windows}
+            done = 0
+            for f in _completed_until_cancel(future_map, lambda: _is_cancelled(thread_obj, cancel_event)):
+                win = future_map.pop(f)
+                for gi, arr in f.result().items():
+                    dsts[gi].write(arr, window=win)
+                done += 1
+                if progress_cb:
+                    progress_cb(int(done * 100 / total))
+        if done < total:
+            raise InterruptedError(f"已取消：完成 {done}/{total} 块")
+    except InterruptedError as e:
+        if log:
+            log(str(e))
+        raise
+    except Exception as e:
+        if error:
+            error(f"处理过程中出现错误：{e}")
+        raise
+    finally:
+        for dst in dsts:
+            dst.close()
+        handles.close()
+        clear_feather_cache()
+    if group_stats is not None:
+        for key, band_stats in zip(keys, group_stats):
+            band_stats.pixels = width * height
+            band_stats.write(out_paths[key])
+            if log:
+                log(f"[{key}] {band_stats.summary()}")
+    if log:
+        log(f"✅ 已输出 {len(keys)} 组：{', '.join(out_paths.values())}")
+    return out_paths
+
+
+def parse_aoi(text):
+    """命令行 AOI：四个逗号分隔的数字视为外包框，否则视为矢量文件路径"""
+    if not text:
+        return None
+    parts = text.split(',')
+    if len(parts) == 4:
+        try:
+            return tuple(float(v) for v in parts)
+        except ValueError:
+            pass
+    return text
+
+# 命令行入口
+def main(argv=None):
+    import argparse
+    import signal
+    parser = argparse.ArgumentParser(description="遥感影像重叠区域融合拼接")
+    parser.add_argument('files', nargs='+', help="输入影像文件")
+    parser.add_argument('-o', '--out', required=True, help="输出文件路径")
+    parser.add_argument('-m', '--method', default='mean',
+                        choices=['mean', 'max', 'min', 'sum', 'first', 'last', 'feather'],
+                        help="重叠区域融合方法")
+    parser.add_argument('--block-size', type=int, default=512, help="分块窗口大小（像素）")
+    parser.add_argument('--workers', type=int, default=4, help="线程数")
+    parser.add_argument('--dtype', default='Float32', help="输出像素类型，如 Float32、UInt16")
+    parser.add_argument('--nodata', type=float, default=None, help="输出 nodata 值")
+    parser.add_argument('--crs', default=None, help="输出坐标系")
+    parser.add_argument('--co', action='append', default=None, help="创建选项，如 COMPRESS=LZW，可重复")
+    parser.add_argument('--flush-interval', type=int, default=100, help="每写入多少块刷新一次缓存")
+    parser.add_argument('--bands', default=None, help="输出波段（逗号分隔，从 1 开始），默认全部")
+    parser.add_argument('--prefetch-depth', type=int, default=0, help="预读窗口数，0 表示不预读")
+    parser.add_argument('--prefetch-mb', type=int, default=256, help="预读缓冲区上限（MB）")
+    parser.add_argument('--memmap-dir', default=None, help="本地临时目录，先归约到 memmap 再顺序编码输出")
+    parser.add_argument('--shard-index', type=int, default=0, help="分片序号（从 0 开始）")
+    parser.add_argument('--shard-count', type=int, default=1, help="分片总数")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="本机多进程分片处理的进程数，需配合 --shard-count")
+    parser.add_argument('--assemble', action='store_true',
+                        help="只合并已完成的分片到输出（.vrt 输出则仅生成 VRT）")
+    parser.add_argument('--compress-threads', default='ALL_CPUS',
+                        help="输出压缩线程数（GTiff NUM_THREADS），0 表示单线程")
+    parser.add_argument('--engine', default='windowed', choices=['windowed', 'auto', 'vrt'],
+                        help="拼接引擎：windowed 为本模块分块引擎，auto 自动选择，vrt 为 VRT + gdal.Warp")
+    parser.add_argument('--target-res', default=None,
+                        help="输出分辨率，x 或 x,y（坐标系单位），默认使用最细的输入分辨率")
+    parser.add_argument('--resample', default='nearest', choices=list(resample_map),
+                        help="源与输出分辨率不同时的重采样方法")
+    parser.add_argument('--stats', action='store_true', help="写出时同步计算统计量和直方图，写入 .aux.xml")
+    parser.add_argument('--hist-bins', type=int, default=256, help="直方图桶数，0 表示不统计直方图")
+    parser.add_argument('--hist-range', default=None, help="直方图范围 min,max，默认仅 8/16 位整型自动统计")
+    parser.add_argument('--aoi', default=None,
+                        help="感兴趣区：minx,miny,maxx,maxy（输入坐标系）或矢量文件路径")
+    parser.add_argument('--group-by', default=None, choices=['date', 'metadata', 'regex'],
+                        help="按文件名日期、元数据日期或正则分组，每组输出一幅（输出路径可含 {group}）")
+    parser.add_argument('--group-period', default='day', choices=['day', 'month', 'year'],
+                        help="按日期分组时的周期")
+    parser.add_argument('--group-pattern', default=None, help="--group-by regex 时用于提取组名的正则")
+    parser.add_argument('--tiles', default=None, choices=['png', 'webp'],
+                        help="输出 XYZ 瓦片金字塔（-o 为目录或 .mbtiles 文件）")
+    parser.add_argument('--zoom', default=None, help="瓦片缩放级别范围 min-max，默认自动")
+    parser.add_argument('--validity-index', action='store_true',
+                        help="为含 nodata 区的源建立有效性位图，跳过有效区不触及的窗口（适合斜条带数据）")
+    parser.add_argument('--window-order', default='hilbert', choices=list(WINDOW_ORDERS),
+                        help="窗口派发顺序，hilbert / zorder 让相邻窗口连续处理，提高源数据块缓存复用")
+    parser.add_argument('--cache-mb', type=int, default=None,
+                        help="每个工作线程分到的 GDAL 块缓存（MB），默认全进程 100MB")
+    parser.add_argument('--input-cache', default=None,
+                        help="转换缓存目录：ASC / PNG 等慢速格式先转成分块 GeoTIFF 再读取")
+    parser.add_argument('--input-cache-gb', type=float, default=10, help="转换缓存目录容量上限（GB）")
+    parser.add_argument('--dry-run', action='store_true', help="只输出规划和资源预估，不处理像素")
+    parser.add_argument('--memory-limit-mb', type=int, default=None, help="预估峰值内存超过该值则拒绝执行")
+    args = parser.parse_args(argv)
+
+    if args.assemble:
+        assemble_shards(args.out, args.shard_count, creation_options=args.co, log=print)
+        return
+
+    bands = [int(b) for b in args.bands.split(',') if b.strip()] if args.bands else None
+    target_res = None
+    if args.target_res:
+        parts = [float(v) for v in args.target_res.split(',')]
+        target_res = parts[0] if len(parts) == 1 else tuple(parts[:2])
+    kwargs = dict(method=args.method,
+                  block_size=args.block_size,
+                  n_workers=args.workers,
+                  dst_dtype=args.dtype,
+                  dst_nodata=args.nodata,
+                  dst_crs=args.crs,
+                  creation_options=args.co,
+                  flush_interval=args.flush_interval,
+                  bands=bands,
+                  resample=args.resample,
+                  target_res=target_res,
+                  stats=args.stats,
+                  aoi=parse_aoi(args.aoi),
+                  tile_format=args.tiles,
+                  zoom_levels=tuple(int(z) for z in args.zoom.split('-')) if args.zoom else None,
+                  validity_index=args.validity_index,
+                  window_order=args.window_order,
+                  cache_mb_per_worker=args.cache_mb,
+                  input_cache_dir=args.input_cache,
+                  input_cache_bytes=int(args.input_cache_gb * 1024 ** 3),
+                  hist_bins=args.hist_bins,
+                  hist_range=tuple(float(v) for v in args.hist_range.split(',')) if args.hist_range else None,
+                  memmap_dir=args.memmap_dir,
+                  prefetch_depth=args.prefetch_depth,
+                  prefetch_bytes=args.prefetch_mb * 1024 * 1024,
+                  compress_threads=None if args.compress_threads == '0' else args.compress_threads,
+                  dry_run=args.dry_run,
+                  memory_limit=args.memory_limit_mb * 1024 * 1024 if args.memory_limit_mb else None)
+    # 分组输出只有分块引擎支持，先于引擎选择处理
+    if args.group_by:
+        if args.engine == 'vrt':
+            parser.error("--group-by 只支持 windowed 引擎")
+        from temporal_groups import group_files
+        groups = group_files(expand_inputs(args.files), args.group_by, args.group_period, args.group_pattern)
+        cancel_event = threading.Event()
+        signal.signal(signal.SIGINT, lambda signum, frame: cancel_event.set())
+        try:
+            mosaic_groups(groups, args.out,
+                          **{k: kwargs[k] for k in ('method', 'block_size', 'n_workers', 'dst_dtype',
+                                                    'dst_nodata', 'dst_crs', 'creation_options', 'resample',
+                                                    'target_res', 'bands', 'compress_threads',
+                                                    'validity_index', 'window_order', 'input_cache_dir',
+                                                    'input_cache_bytes', 'aoi', 'stats', 'hist_bins',
+                                                    'hist_range', 'dry_run')},
+                          log=print, error=print, cancel_event=cancel_event)
+        except InterruptedError:
+            raise SystemExit(130)
+        return
+    if args.engine != 'windowed' and args.processes and args.shard_count > 1:
+        # 多进程分片只有分块引擎支持
+        if args.engine == 'vrt':
+            parser.error("--processes / --shard-count 只支持 windowed 引擎")
+        args.engine = 'windowed'
+    if args.engine != 'windowed':
+        from merge_engine import merge
+        kwargs.update(shard_index=args.shard_index, shard_count=args.shard_count)
+        for key in ('method', 'dst_dtype', 'dst_nodata', 'dst_crs', 'creation_options', 'bands'):
+            kwargs.pop(key)
+        merge(args.files, args.out,
+              method=args.method,
+              engine=args.engine,
+              dst_dtype=args.dtype,
+              dst_nodata=args.nodata,
+              dst_crs=args.crs,
+              creation_options=args.co,
+              bands=bands,
+              log=print,
+              **kwargs)
+        return
+    if args.processes and args.shard_count > 1:
+        mosaic_sharded(args.files, args.out, args.shard_count, n_procs=args.processes, log=print, **kwargs)
+        return
+    # Ctrl+C / SIGTERM 只置位取消事件，已在处理的窗口写完后正常退出
+    cancel_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: cancel_event.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: cancel_event.set())
+    try:
+        mosaic_overlap(files=args.files,
+                       out_path=args.out,
+                       shard_index=args.shard_index,
+                       shard_count=args.shard_count,
+                       log=print,
+                       error=print,
+                       cancel_event=cancel_event,
+                       **kwargs)
+    except InterruptedError:
+        raise SystemExit(130)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# mosaic_reader.py
+import threading
+from collections import OrderedDict
+from typing import List
+import numpy as np
+import rasterio
+from rasterio.windows import Window, from_bounds
+from rasterio.transform import from_bounds as transform_from_bounds
+from mosaic_overlap import (build_rtree_index, scan_headers, _SourceHandles, _WindowBuffers,
+                            _read_source, _reduce_window, _check_bands, clear_feather_cache, dtype_map, resample_map)
+from archive_inputs import expand_inputs
+
+
+class Mosaic:
+    """按需计算的拼接结果：只归约被请求的区域，归约后的瓦片按 LRU 缓存
+
+    网格与 mosaic_overlap 一致（最细的输入分辨率或 target_res），可在多线程中并发调用 read。
+    """
+
+    def __init__(self,
+                 files: List[str],
+                 method: str = 'mean',
+                 tile_size: int = 256,
+                 dst_dtype: str = 'float32',
+                 dst_nodata = None,
+                 bands: List[int] = None,
+                 target_res = None,
+                 resample: str = 'nearest',
+                 cache_bytes: int = 256 * 1024 * 1024, # 瓦片缓存上限（字节）
+                 max_open: int = 64, # 每个线程最多同时打开的源文件数
+                 validity_index: bool = False): # 为含 nodata 区的源建立有效性位图，跳过不触及的瓦片
+        if resample not in resample_map:
+            raise ValueError(f"Unsupported resample method: {resample}")
+        self.files = expand_inputs(files)
+        if not self.files:
+            raise ValueError("No input files")
+        self.method = method
+        self.tile_size = tile_size
+        self._resampling = resample_map[resample]
+
+        bounds_list, resolutions, _ = scan_headers(self.files)
+        with rasterio.open(self.files[0]) as ref:
+            src_bands = ref.count
+            src_dtype = ref.dtypes[0]
+            self.crs = ref.crs
+            self.nodata = dst_nodata if dst_nodata is not None else ref.nodata
+
+        left = min(b.left for b in bounds_list)
+        bottom = min(b.bottom for b in bounds_list)
+        right = max(b.right for b in bounds_list)
+        top = max(b.top for b in bounds_list)
+        if target_res is not None:
+            res_x, res_y = (target_res, target_res) if np.isscalar(target_res) else target_res
+        else:
+            res_x = min(r[0] for r in resolutions)
+            res_y = min(r[1] for r in resolutions)
+        self.width = max(1, int(round((right - left) / res_x)))
+        self.height = max(1, int(round((top - bottom) / res_y)))
+        self.transform = transform_from_bounds(left, bottom, right, top, self.width, self.height)
+        self.bounds = (left, bottom, right, top)
+
+        self.bands = _check_bands(bands, src_bands)
+        self.count = len(self.bands)
+        self.dtype = dtype_map.get(dst_dtype, src_dtype)
+
+        self._rtree, self._paths = build_rtree_index(self.files, bounds_list)
+        if validity_index:
+            self._rtree.load_validity(self._paths)
+        self._handles = _SourceHandles(self._paths, max_open)
+        self._buffers = _WindowBuffers()
+        self._cache_bytes = cache_bytes
+        self._tiles = OrderedDict()   # (瓦片行, 瓦片列) -> 归约结果 (bands, h, w)
+        self._pending = {}            # 正在计算的瓦片 -> Event，避免多个线程重复计算同一瓦片
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._handles.close()
+        clear_feather_cache()
+        with self._lock:
+            self._tiles.clear()
+            self._cached_bytes = 0
+
+    def _compute_tile(self, tr: int, tc: int):
+        ts = self.tile_size
+        win = Window(tc * ts, tr * ts, min(ts, self.width - tc * ts), min(ts, self.height - tr * ts))
+        win_bounds = rasterio.windows.bounds(win, self.transform)
+        arrays, masks, weights = [], [], []
+        # 候选源按输入顺序排列，保证 first / last 语义
+        for fid in self._rtree.candidates(win_bounds):
+            try:
+                src = self._handles.get(fid)
+                out = self._buffers.get(len(arrays), self.count, win.height, win.width, src.dtypes[0])
+                read = _read_source(src, self._paths[fid], win_bounds, win.height, win.width,
+                                    self.transform, self.method, self.bands, self._resampling, out)
+            except Exception:
+                continue
+            if read is None:
+                continue
+            arrays.append(read[0])
+            masks.append(read[1])
+            if read[2] is not None:
+                weights.append(read[2])
+        return _reduce_window(arrays, masks, weights, win.height, win.width, self.method,
+                              self.nodata, self.dtype, self.count)
+
+    def _tile(self, tr: int, tc: int):
+        key = (tr, tc)
+        while True:
+            with self._lock:
+                tile = self._tiles.get(key)
+                if tile is not None:
+                    self._tiles.move_to_end(key)
+                    self.hits += 1
+                    return tile
+                event = self._pending.get(key)
+                if event is None:
+                    self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # 其他线程正在计算同一瓦片，等待后重新取缓存
+            event.wait()
+
+        try:
+            tile = self._compute_tile(tr, tc)
+            with self._lock:
+                self._tiles[key] = tile
+                self._cached_bytes += tile.nbytes
+                while self._cached_bytes > self._cache_bytes and len(self._tiles) > 1:
+                    _, old = self._tiles.popitem(last=False)
+                    self._cached_bytes -= old.nbytes
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+        return tile
+
+    def read(self, window: Window = None, bounds=None, bands: List[int] = None) -> np.ndarray:
+        """读取拼接结果的一个窗口（或地理范围），返回 (bands, h, w)，网格外填充 nodata
+
+        bands 为输出波段号（对应构造时 bands 中的位置，从 1 开始），None 表示全部。
+        """
+        if window is None:
+            if bounds is None:
+                window = Window(0, 0, self.width, self.height)
+            else:
+                window = from_bounds(*bounds, self.transform)
+        window = window.round_offsets().round_lengths()
+        row0, col0 = int(window.row_off), int(window.col_off)
+        h, w = int(window.height), int(window.width)
+        idx = [b - 1 for b in bands] if bands else list(range(self.count))
+
+        out = np.full((len(idx), h, w), self.nodata if self.nodata is not None else 0, dtype=self.dtype)
+        r0, r1 = max(row0, 0), min(row0 + h, self.height)
+        c0, c1 = max(col0, 0), min(col0 + w, self.width)
+        if r1 <= r0 or c1 <= c0:
+            return out
+        ts = self.tile_size
+        for tr in range(r0 // ts, (r1 - 1) // ts + 1):
+            for tc in range(c0 // ts, (c1 - 1) // ts + 1):
+                tile = self._tile(tr, tc)
+                # 瓦片与请求窗口的相交部分
+                tr0, tc0 = tr * ts, tc * ts
+                ir0, ir1 = max(r0, tr0), min(r1, tr0 + tile.shape[1])
+                ic0, ic1 = max(c0, tc0), min(c1, tc0 + tile.shape[2])
+                out[:, ir0 - row0:ir1 - row0, ic0 - col0:ic1 - col0] = \
+                    tile[idx, ir0 - tr0:ir1 - tr0, ic0 - tc0:ic1 - tc0]
+        return out
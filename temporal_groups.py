@@ -0,0 +1,87 @@
+# temporal_groups.py
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List
+import rasterio
+
+# 文件名中的日期：YYYYMMDD / YYYY-MM-DD / YYYY_MM_DD，以及 MODIS 的 AYYYYDDD（年 + 年积日）
+DATE_PATTERNS = [
+    (re.compile(r'(?<!\d)(\d{4})[-_]?(\d{2})[-_]?(\d{2})(?!\d)'), '%Y%m%d'),
+    (re.compile(r'A(\d{4})(\d{3})(?!\d)'), '%Y%j'),
+]
+
+# 元数据中可能记录采集时间的键（GeoTIFF、Landsat/Sentinel、MODIS HDF）
+DATE_TAGS = ['ACQUISITIONDATETIME', 'DATE_ACQUIRED', 'SENSING_TIME', 'RANGEBEGINNINGDATE', 'TIFFTAG_DATETIME']
+
+# 分组周期 -> 组名格式
+PERIOD_FORMAT = {
+    'day': '%Y%m%d',
+    'month': '%Y%m',
+    'year': '%Y',
+}
+
+
+def date_from_name(path: str):
+    """从文件名解析日期，解析不到返回 None"""
+    name = os.path.basename(path)
+    for pattern, fmt in DATE_PATTERNS:
+        for m in pattern.finditer(name):
+            try:
+                return datetime.strptime(''.join(m.groups()), fmt)
+            except ValueError:
+                continue
+    return None
+
+
+def date_from_metadata(path: str):
+    """从影像元数据解析日期，解析不到返回 None"""
+    with rasterio.open(path) as src:
+        tags = src.tags()
+    for key in DATE_TAGS:
+        value = tags.get(key)
+        if not value:
+            continue
+        m = re.search(r'(\d{4})[-:/]?(\d{2})[-:/]?(\d{2})', value)
+        if m:
+            try:
+                return datetime.strptime(''.join(m.groups()), '%Y%m%d')
+            except ValueError:
+                continue
+    return None
+
+
+def group_files(files: List[str], group_by: str = 'date', period: str = 'day',
+                pattern: str = None) -> Dict[str, List[str]]:
+    """把输入按日期或正则分组，返回 {组名: 文件列表}（组名有序，组内保持输入顺序）
+
+    group_by 为 'date'（文件名日期）、'metadata'（元数据日期）或 'regex'（pattern 的
+    命名组 group、第一个分组或整个匹配作为组名）。未能分组的文件不参与输出。
+    """
+    if group_by not in ('date', 'metadata', 'regex'):
+        raise ValueError(f"Unsupported group_by: {group_by}")
+    if period not in PERIOD_FORMAT:
+        raise ValueError(f"Unsupported period: {period}")
+    if group_by == 'regex':
+        if not pattern:
+            raise ValueError("group_by='regex' requires a pattern")
+        regex = re.compile(pattern)
+
+    groups = {}
+    for f in files:
+        if group_by == 'regex':
+            m = regex.search(os.path.basename(f))
+            if m is None:
+                continue
+            if 'group' in regex.groupindex:
+                key = m.group('group')
+            else:
+                key = m.group(1) if regex.groups else m.group(0)
+        else:
+            date = date_from_name(f) if group_by == 'date' else date_from_metadata(f)
+            if date is None:
+                continue
+            key = date.strftime(PERIOD_FORMAT[period])
+        groups.setdefault(key, []).append(f)
+    return OrderedDict(sorted(groups.items()))
@@ -0,0 +1,297 @@
+# tile_export.py
+import math
+import os
+import sqlite3
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import from_bounds as window_from_bounds
+from mosaic_reader import Mosaic
+from mosaic_overlap import resample_map, _is_cancelled
+
+# Web Mercator 全球范围（米）
+WEB_MERCATOR = 'EPSG:3857'
+ORIGIN = 20037508.342789244
+TILE_FORMATS = ('png', 'webp')
+
+
+def tile_bounds(z: int, x: int, y: int):
+    """XYZ 瓦片在 Web Mercator 下的范围 (left, bottom, right, top)"""
+    size = 2 * ORIGIN / (1 << z)
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+    return left, top - size, left + size, top
+
+
+def tile_range(bounds, z: int):
+    """覆盖 Web Mercator 范围的瓦片行列号 (x0, y0, x1, y1)，含两端"""
+    n = 1 << z
+    size = 2 * ORIGIN / n
+    left, bottom, right, top = bounds
+    x0 = int(np.clip((left + ORIGIN) // size, 0, n - 1))
+    x1 = int(np.clip((right + ORIGIN) // size, 0, n - 1))
+    y0 = int(np.clip((ORIGIN - top) // size, 0, n - 1))
+    y1 = int(np.clip((ORIGIN - bottom) // size, 0, n - 1))
+    return x0, y0, x1, y1
+
+
+def native_zoom(mosaic: Mosaic, merc_bounds, tile_size: int = 256) -> int:
+    """与拼接结果分辨率最接近且不低于它的缩放级别"""
+    res_m = (merc_bounds[2] - merc_bounds[0]) / mosaic.width
+    return int(max(0, min(24, math.ceil(math.log2(2 * ORIGIN / (tile_size * res_m))))))
+
+
+class _TileSink:
+    """瓦片写入目标：目录（{z}/{x}/{y}.ext）或 MBTiles（SQLite，TMS 行号）"""
+
+    def __init__(self, out_path: str, fmt: str):
+        self.fmt = fmt
+        self.mbtiles = out_path.lower().endswith('.mbtiles')
+        self.out_path = out_path
+        self._lock = threading.Lock()
+        if self.mbtiles:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            self._db = sqlite3.connect(out_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+            self._db.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+                             "tile_row INTEGER, tile_data BLOB)")
+            self._db.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        else:
+            os.makedirs(out_path, exist_ok=True)
+
+    def write(self, z: int, x: int, y: int, data: bytes):
+        if self.mbtiles:
+            # SQLite 连接不支持并发写，编码在各线程并行完成，这里只串行插入
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                                 (z, x, (1 << z) - 1 - y, sqlite3.Binary(data)))
+        else:
+            folder = os.path.join(self.out_path, str(z), str(x))
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, f"{y}.{self.fmt}"), 'wb') as f:
+                f.write(data)
+
+    def close(self, metadata: dict = None):
+        if not self.mbtiles:
+            return
+        with self._lock:
+            if metadata:
+                self._db.executemany("INSERT INTO metadata VALUES (?, ?)",
+                                     [(k, str(v)) for k, v in metadata.items()])
+            self._db.commit()
+            self._db.close()
+
+
+def _encode(rgba: np.ndarray, fmt: str) -> bytes:
+    """把 (4, h, w) 的 RGBA 编码为 PNG / WebP"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', rasterio.errors.NotGeoreferencedWarning)
+        with MemoryFile() as mf:
+            with mf.open(driver=fmt.upper(), width=rgba.shape[2], height=rgba.shape[1],
+                         count=4, dtype='uint8') as ds:
+                ds.write(rgba)
+            return mf.read()
+
+
+def _downsample(children, tile_size: int):
+    """把 2x2 子瓦片（RGBA，可为 None）合成为上一级瓦片，颜色按 alpha 加权平均"""
+    if all(c is None for c in children):
+        return None
+    full = np.zeros((4, tile_size * 2, tile_size * 2), dtype=np.float32)
+    for k, child in enumerate(children):
+        if child is not None:
+            dy, dx = divmod(k, 2)
+            full[:, dy * tile_size:(dy + 1) * tile_size, dx * tile_size:(dx + 1) * tile_size] = child
+    quad = full.reshape(4, tile_size, 2, tile_size, 2)
+    alpha = quad[3].sum(axis=(1, 3))
+    rgb = (quad[:3] * quad[3][None]).sum(axis=(2, 4)) / np.maximum(alpha, 1)[None]
+    out = np.empty((4, tile_size, tile_size), dtype=np.uint8)
+    out[:3] = np.clip(np.round(rgb), 0, 255)
+    out[3] = np.round(alpha / 4)
+    return out if out[3].any() else None
+
+
+def export_tiles(files: List[str],
+                 out_path: str,
+                 min_zoom: int = None,
+                 max_zoom: int = None,
+                 method: str = 'mean',
+                 tile_format: str = 'png',
+                 tile_size: int = 256,
+                 n_workers: int = 4,
+                 bands: List[int] = None, # 1 个波段输出灰度，3 个及以上取前 3 个作 RGB
+                 value_range = None, # 拉伸到 0-255 的取值范围 (min, max)，None 时 Byte 不拉伸，其他自动估计
+                 dst_nodata = None,
+                 resample: str = 'bilinear', # 重投影到 Web Mercator 的重采样方法
+                 target_res = None, # 拼接网格分辨率，None 表示使用最细的输入分辨率
+                 src_resample: str = 'nearest', # 源与拼接网格分辨率不同时的重采样方法
+                 validity_index: bool = False, # 为含 nodata 区的源建立有效性位图
+                 log = None,
+                 thread_obj=None,
+                 progress_cb=None,
+                 cancel_event: threading.Event = None) -> str:
+    """把拼接结果直接输出为 Web Mercator XYZ 瓦片金字塔（目录或 .mbtiles）
+
+    最高级别瓦片从按需归约的 Mosaic 读取并重投影，低级别由子瓦片自下而上合成，
+    整个过程只遍历一次；全空瓦片不写出。
+    """
+    tile_format = tile_format.lower()
+    if tile_format not in TILE_FORMATS:
+        raise ValueError(f"Unsupported tile format: {tile_format}")
+    if resample not in resample_map:
+        raise ValueError(f"Unsupported resample method: {resample}")
+    resampling = resample_map[resample]
+
+    mosaic = Mosaic(files, method=method, tile_size=512, dst_nodata=dst_nodata, bands=bands,
+                    target_res=target_res, resample=src_resample, validity_index=validity_index)
+    bands_used = [1] if mosaic.count < 3 else [1, 2, 3]
+    nodata = mosaic.nodata
+
+    merc_bounds = transform_bounds(mosaic.crs, WEB_MERCATOR, *mosaic.bounds)
+    if max_zoom is None:
+        max_zoom = native_zoom(mosaic, merc_bounds, tile_size)
+    if min_zoom is None:
+        extent = max(merc_bounds[2] - merc_bounds[0], merc_bounds[3] - merc_bounds[1])
+        min_zoom = int(np.clip(math.floor(math.log2(2 * ORIGIN / extent)), 0, max_zoom))
+    if not 0 <= min_zoom <= max_zoom:
+        raise ValueError(f"Invalid zoom range {min_zoom}-{max_zoom}")
+
+    # 拉伸范围：非 Byte 数据用低分辨率预览的 2%-98% 分位数
+    if value_range is None and np.dtype(mosaic.dtype) != np.uint8:
+        preview_res = max(abs(mosaic.transform.a), abs(mosaic.transform.e)) * max(1, max(mosaic.width, mosaic.height) / 1024)
+        with Mosaic(files, method=method, dst_nodata=dst_nodata, bands=bands, target_res=preview_res,
+                    resample='average', validity_index=validity_index) as preview:
+            sample = preview.read(bands=bands_used).astype(np.float64)
+        valid = np.isfinite(sample) & ((sample != nodata) if nodata is not None else True)
+        value_range = tuple(float(v) for v in np.percentile(sample[valid], (2, 98))) if valid.any() else (0.0, 255.0)
+    if log:
+        log(f"瓦片金字塔：缩放级别 {min_zoom}-{max_zoom}，格式 {tile_format}，拉伸范围 {value_range}")
+
+    def render(z, x, y):
+        """从 Mosaic 读取并重投影一个最高级别瓦片，全空时返回 None"""
+        left, bottom, right, top = tile_bounds(z, x, y)
+        src_bounds = transform_bounds(WEB_MERCATOR, mosaic.crs, left, bottom, right, top)
+        win = window_from_bounds(*src_bounds, mosaic.transform).round_offsets().round_lengths()
+        # 四周各多读 1 个像素，保证重采样在瓦片边缘也有邻域
+        win = rasterio.windows.Window(win.col_off - 1, win.row_off - 1, win.width + 2, win.height + 2)
+        if (win.col_off >= mosaic.width or win.row_off >= mosaic.height
+                or win.col_off + win.width <= 0 or win.row_off + win.height <= 0):
+            return None
+        src = mosaic.read(window=win, bands=bands_used).astype(np.float32)
+        fill = nodata if nodata is not None else np.nan
+        dst = np.full((len(bands_used), tile_size, tile_size), fill, dtype=np.float32)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', rasterio.errors.NotGeoreferencedWarning)
+            reproject(src, dst,
+                      src_transform=rasterio.windows.transform(win, mosaic.transform), src_crs=mosaic.crs,
+                      src_nodata=fill,
+                      dst_transform=from_bounds(left, bottom, right, top, tile_size, tile_size),
+                      dst_crs=WEB_MERCATOR, dst_nodata=fill, resampling=resampling)
+        valid = np.isfinite(dst).all(axis=0)
+        if nodata is not None:
+            valid &= (dst != nodata).all(axis=0)
+        if not valid.any():
+            return None
+        if value_range is not None:
+            lo, hi = value_range
+            dst = (dst - lo) * (255.0 / max(hi - lo, 1e-12))
+        rgba = np.zeros((4, tile_size, tile_size), dtype=np.uint8)
+        rgba[:3] = np.clip(np.round(np.nan_to_num(dst)), 0, 255)[[0, 0, 0] if len(bands_used) == 1 else [0, 1, 2]]
+        rgba[3] = np.where(valid, 255, 0)
+        return rgba
+
+    sink = _TileSink(out_path, tile_format)
+    is_cancelled = lambda: _is_cancelled(thread_obj, cancel_event)
+    counter = {'done': 0, 'written': 0}
+    counter_lock = threading.Lock()
+    x0, y0, x1, y1 = tile_range(merc_bounds, max_zoom)
+    n_leaves = (x1 - x0 + 1) * (y1 - y0 + 1)
+
+    def emit(z, x, y, rgba):
+        if rgba is not None:
+            sink.write(z, x, y, _encode(rgba, tile_format))
+            with counter_lock:
+                counter['written'] += 1
+
+    def build(z, x, y):
+        """自下而上生成以 (z, x, y) 为根的子树，返回该瓦片的 RGBA（全空为 None）"""
+        if is_cancelled():
+            raise InterruptedError("已取消瓦片输出")
+        if z == max_zoom:
+            rgba = render(z, x, y)
+            with counter_lock:
+                counter['done'] += 1
+                done = counter['done']
+            if progress_cb:
+                progress_cb(int(done * 100 / max(n_leaves, 1)))
+        else:
+            children = []
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    cx, cy = 2 * x + dx, 2 * y + dy
+                    x0, y0, x1, y1 = tile_range(merc_bounds, z + 1)
+                    if x0 <= cx <= x1 and y0 <= cy <= y1:
+                        children.append(build(z + 1, cx, cy))
+                    else:
+                        children.append(None)
+            rgba = _downsample(children, tile_size)
+        emit(z, x, y, rgba)
+        return rgba
+
+    # 选一个瓦片数足够多的中间级别，每个工作线程负责其中一棵子树；其上各级在主线程合成
+    split = min_zoom
+    while split < max_zoom:
+        x0, y0, x1, y1 = tile_range(merc_bounds, split)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) >= 4 * n_workers:
+            break
+        split += 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            x0, y0, x1, y1 = tile_range(merc_bounds, split)
+            futures = {(x, y): pool.submit(build, split, x, y)
+                       for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)}
+
+            def build_upper(z, x, y):
+                if z == split:
+                    return futures[(x, y)].result()
+                children = []
+                for dy in (0, 1):
+                    for dx in (0, 1):
+                        key = (2 * x + dx, 2 * y + dy)
+                        cx0, cy0, cx1, cy1 = tile_range(merc_bounds, z + 1)
+                        inside = cx0 <= key[0] <= cx1 and cy0 <= key[1] <= cy1
+                        children.append(build_upper(z + 1, *key) if inside else None)
+                rgba = _downsample(children, tile_size)
+                emit(z, x, y, rgba)
+                return rgba
+
+            try:
+                x0, y0, x1, y1 = tile_range(merc_bounds, min_zoom)
+                for y in range(y0, y1 + 1):
+                    for x in range(x0, x1 + 1):
+                        build_upper(min_zoom, x, y)
+            except BaseException:
+                for f in futures.values():
+                    f.cancel()
+                raise
+    finally:
+        sink.close({
+            'name': os.path.splitext(os.path.basename(out_path))[0],
+            'format': tile_format,
+            'type': 'overlay',
+            'minzoom': min_zoom,
+            'maxzoom': max_zoom,
+            'bounds': ','.join(f"{v:.6f}" for v in transform_bounds(mosaic.crs, 'EPSG:4326', *mosaic.bounds)),
+        })
+        mosaic.close()
+    if log:
+        log(f"✅ 已写出 {counter['written']} 个瓦片：{out_path}")
+    return out_path
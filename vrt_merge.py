@@ -0,0 +1,156 @@
+# vrt_merge.py
+import xml.etree.ElementTree as ET
+from typing import List, Tuple
+from osgeo import gdal
+
+# GDAL 内置像素函数（可忽略 nodata）及其最低版本号
+NATIVE_PIXEL_FN = {
+    'sum': 3080000,
+    'min': 3080000,
+    'max': 3080000,
+    'mean': 3110000,
+}
+
+# add_pixel_fn 返回值对应的说明，用于日志
+PIXEL_FN_DESC = {
+    'order': "按源顺序覆盖（无需像素函数）",
+    'native': "GDAL 内置像素函数（propagateNoData=false）",
+    'python': "Python 像素函数（GDAL 版本过低时的兼容路径，在 GIL 下逐块计算，速度较慢；升级到 GDAL >= 3.11 可使用内置函数）",
+}
+
+# 旧版 GDAL 没有内置函数时的 Python 像素函数，用普通数组运算代替 np.ma
+PYTHON_PIXEL_FN_CODE = """
+import numpy as np
+
+nodata = float("{nodata}")
+
+def _stack(in_ar):
+    data = np.stack(in_ar).astype('float64')
+    valid = ~np.isnan(data) if np.isnan(nodata) else data != nodata
+    return data, valid
+
+def max(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
+    data, valid = _stack(in_ar)
+    result = np.where(valid, data, -np.inf).max(axis=0)
+    out_ar[:] = np.where(valid.any(axis=0), result, nodata)
+
+def min(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
+    data, valid = _stack(in_ar)
+    result = np.where(valid, data, np.inf).min(axis=0)
+    out_ar[:] = np.where(valid.any(axis=0), result, nodata)
+
+def sum(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
+    data, valid = _stack(in_ar)
+    result = np.where(valid, data, 0).sum(axis=0)
+    out_ar[:] = np.where(valid.any(axis=0), result, nodata)
+
+def mean(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
+    data, valid = _stack(in_ar)
+    count = valid.sum(axis=0)
+    total = np.where(valid, data, 0).sum(axis=0)
+    out_ar[:] = np.where(count > 0, total / np.maximum(count, 1), nodata)
+
+def first(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
+    data, valid = _stack(in_ar)
+    idx = valid.argmax(axis=0)[None]
+    result = np.take_along_axis(data, idx, axis=0)[0]
+    out_ar[:] = np.where(valid.any(axis=0), result, nodata)
+
+def last(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt):
+    data, valid = _stack(in_ar)
+    idx = (len(in_ar) - 1 - np.flip(valid, axis=0).argmax(axis=0))[None]
+    result = np.take_along_axis(data, idx, axis=0)[0]
+    out_ar[:] = np.where(valid.any(axis=0), result, nodata)
+"""
+
+
+def get_nodata_from_vrt(vrt_path: str) -> float:
+    tree = ET.parse(vrt_path)
+    root = tree.getroot()
+    for band in root.findall("VRTRasterBand"):
+        nd = band.find("NoDataValue")
+        if nd is not None:
+            return nd.text
+    return None
+
+
+def native_pixel_fn_available(method: str) -> bool:
+    """当前 GDAL 是否提供该方法的内置像素函数"""
+    need = NATIVE_PIXEL_FN.get(method)
+    return need is not None and int(gdal.VersionInfo('VERSION_NUM')) >= need
+
+
+def add_pixel_fn(filename: str, function_name: str, engine: str = 'native') -> str:
+    """通过 XML 把 VRT 的每个波段改为派生波段并设置像素函数
+
+    返回实际使用的方式：'order'（first/last 由源顺序决定，无需像素函数）、
+    'native'（GDAL 内置像素函数）或 'python'（Python 像素函数）。
+    """
+    if engine != 'python' and function_name in ('first', 'last'):
+        return 'order'
+
+    used = 'native' if engine != 'python' and native_pixel_fn_available(function_name) else 'python'
+    nodata = get_nodata_from_vrt(filename)
+    if nodata is None:
+        nodata = -9999
+
+    tree = ET.parse(filename)
+    root = tree.getroot()
+    for band in root.findall("VRTRasterBand"):
+        band.set('subClass', 'VRTDerivedRasterBand')
+        # 去掉已有的像素函数定义
+        for tag in ('PixelFunctionType', 'PixelFunctionLanguage',
+                    'PixelFunctionCode', 'PixelFunctionArguments'):
+            for old in band.findall(tag):
+                band.remove(old)
+        ET.SubElement(band, 'PixelFunctionType').text = function_name
+        if used == 'native':
+            # 任一源为 nodata 时不把整个像元置为 nodata，只在有效源之间计算
+            ET.SubElement(band, 'PixelFunctionArguments', propagateNoData='false')
+        else:
+            ET.SubElement(band, 'PixelFunctionLanguage').text = 'Python'
+            ET.SubElement(band, 'PixelFunctionCode').text = PYTHON_PIXEL_FN_CODE.format(nodata=nodata)
+    tree.write(filename)
+    return used
+
+
+def build_merge_vrt(vrt_path: str, files: List[str], method: str,
+                    engine: str = 'native', bands: List[int] = None) -> Tuple[str, str]:
+    """构建带融合规则的 VRT，返回 (实际使用的方式, nodata)"""
+    # VRT 中后面的源覆盖前面的源，first 只需把源顺序反过来
+    srcs = list(reversed(files)) if method == 'first' and engine != 'python' else list(files)
+    vrt_ds = gdal.BuildVRT(vrt_path, srcs, bandList=bands)
+    vrt_ds = None
+    nodata = get_nodata_from_vrt(vrt_path)
+    used = add_pixel_fn(vrt_path, method, engine)
+    return used, nodata
+
+
+def warp_merged_vrt(vrt_path: str, out_path: str, opts: dict, used: str, callback=None) -> None:
+    """把融合 VRT 导出为结果文件"""
+    opts = dict(opts)
+    if used == 'python':
+        gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', 'YES')
+    if opts.get('multithread'):
+        # 内置像素函数不经过 Python，多线程 warp 才真正并行
+        warp_options = list(opts.get('warpOptions') or [])
+        if not any(o.upper().startswith('NUM_THREADS=') for o in warp_options):
+            warp_options.append('NUM_THREADS=ALL_CPUS')
+        opts['warpOptions'] = warp_options
+        # 输出数据块也由 GTiff 驱动多线程压缩
+        creation_options = list(opts.get('creationOptions') or [])
+        if not any(o.upper().startswith('NUM_THREADS=') for o in creation_options):
+            creation_options.append('NUM_THREADS=ALL_CPUS')
+        opts['creationOptions'] = creation_options
+
+    ds = gdal.Open(vrt_path)
+    if ds is None:
+        raise RuntimeError("Failed to open the VRT dataset. Check if PixelFunction is valid.")
+
+    gdal.Warp(out_path, ds, **opts, callback=callback)
+    ds = None
+    # 刷新缓存并关闭
+    out_ds = gdal.Open(out_path, gdal.GA_Update)
+    if out_ds:
+        out_ds.FlushCache()  # 强制写盘
+        out_ds = None